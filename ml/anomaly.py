@@ -0,0 +1,233 @@
+import json
+import threading
+from collections import deque
+from pathlib import Path
+import numpy as np
+
+METRICS = ("pm25", "pm10")
+
+# EWMA weight per sample; mean and variance are updated with Huber-clipped
+# residuals so a spike does not widen the band it is measured against.
+ALPHA = 0.05
+HUBER_Z = 3.0
+SPIKE_Z = 5.0
+SPIKE_END_Z = 2.0
+# A "spike" that lasts this many samples is a new level, not a spike
+SPIKE_MAX_SAMPLES = 30
+# Two-sided CUSUM on the clipped z-score (slack, decision threshold)
+CUSUM_K = 0.5
+CUSUM_H = 12.0
+WARMUP_SAMPLES = 30
+MIN_STD = 0.5
+MAX_EVENTS = 20
+
+# Per-metric state vector
+MEAN, VAR, CUSUM_POS, CUSUM_NEG, COUNT, SPIKE_START, SPIKE_PEAK, SPIKE_LEN, LAST_Z = range(9)
+FIELDS = 9
+
+
+def empty_state() -> np.ndarray:
+    state = np.zeros((len(METRICS), FIELDS), dtype=np.float64)
+    state[:, SPIKE_START] = -1.0
+    return state
+
+
+def update_metric(s: list, ts: np.ndarray, values: np.ndarray, metric: str, events: list) -> None:
+    # s is the metric's state as a plain list: float ops in the loop are
+    # several times cheaper than numpy scalar indexing.
+    mean, var, cpos, cneg, count, spike_start, spike_peak, spike_len, z = s
+    min_var = MIN_STD * MIN_STD
+    for t, x in zip(ts.tolist(), values.tolist()):
+        if x != x:
+            continue
+        if count == 0:
+            mean, var, count = x, max((0.1 * x) ** 2, min_var), 1.0
+            continue
+        std = max(var, min_var) ** 0.5
+        z = (x - mean) / std
+        count += 1.0
+        warm = count > WARMUP_SAMPLES
+
+        shifted = False
+        if spike_start >= 0:
+            spike_len += 1.0
+            if x > spike_peak:
+                spike_peak = x
+            if z < SPIKE_END_Z:
+                events.append({"metric": metric, "kind": "spike_end", "start": int(spike_start), "end": int(t), "peak": spike_peak})
+                spike_start = -1.0
+            elif spike_len >= SPIKE_MAX_SAMPLES:
+                # Too long for a spike: close it, the level shifted at its onset
+                events.append({"metric": metric, "kind": "spike_end", "start": int(spike_start), "end": int(t), "peak": spike_peak})
+                shifted = True
+            else:
+                # Baseline is frozen while the spike lasts
+                continue
+        elif warm and z > SPIKE_Z:
+            spike_start, spike_peak, spike_len = t, x, 1.0
+            events.append({"metric": metric, "kind": "spike", "start": int(t), "end": None, "peak": x, "z": round(z, 2)})
+            continue
+
+        zc = min(max(z, -HUBER_Z), HUBER_Z)
+        cpos = max(0.0, cpos + zc - CUSUM_K)
+        cneg = max(0.0, cneg - zc - CUSUM_K)
+        if shifted or (warm and (cpos > CUSUM_H or cneg > CUSUM_H)):
+            # Sustained change: re-baseline on the new level
+            events.append(
+                {
+                    "metric": metric,
+                    "kind": "level_shift",
+                    "start": int(spike_start) if shifted else int(t),
+                    "end": None,
+                    "from": round(mean, 2),
+                    "to": x,
+                    "z": round(z, 2),
+                }
+            )
+            mean, cpos, cneg, spike_start = x, 0.0, 0.0, -1.0
+            continue
+
+        r = zc * std
+        mean += ALPHA * r
+        var = (1.0 - ALPHA) * (var + ALPHA * r * r)
+    s[:] = [mean, var, cpos, cneg, count, spike_start, spike_peak, spike_len, z]
+
+
+def describe(state: np.ndarray, last_ts: int) -> dict:
+    out = {"last_timestamp": last_ts}
+    for mi, m in enumerate(METRICS):
+        s = state[mi]
+        out[m] = {
+            "mean": round(float(s[MEAN]), 2),
+            "std": round(float(max(s[VAR], MIN_STD * MIN_STD) ** 0.5), 2),
+            "z": round(float(s[LAST_Z]), 2),
+            "in_spike": bool(s[SPIKE_START] >= 0),
+            "spike_since": int(s[SPIKE_START]) if s[SPIKE_START] >= 0 else None,
+            "warm": bool(s[COUNT] > WARMUP_SAMPLES),
+        }
+    return out
+
+
+class AnomalyDetector:
+    def __init__(self, path: Path | None = None):
+        self.path = path
+        self.states: dict[str, np.ndarray] = {}
+        self.last_ts: dict[str, int] = {}
+        self.events: dict[str, deque] = {}
+        self.lock = threading.Lock()
+        # Persisted by whoever owns the detector (see serve.background_worker)
+        self._dirty = False
+        # (last sensor_data id, ids taken just below it) of the rows fed so
+        # far, saved along with the state they produced
+        self.position: tuple[int, list[int]] | None = None
+
+    def last_seen(self, node: str) -> int | None:
+        return self.last_ts.get(node)
+
+    def update(self, node: str, ts_ms: np.ndarray, pm25: np.ndarray, pm10: np.ndarray) -> list[dict]:
+        # Samples must arrive in time order per node; anything not newer
+        # than what was already seen (e.g. a sample committed late) is
+        # skipped.
+        ts_ms = np.asarray(ts_ms, dtype=np.int64)
+        new_events: list[dict] = []
+        with self.lock:
+            last = self.last_ts.get(node, -1)
+            fresh = ts_ms > last
+            if not fresh.any():
+                return new_events
+            ts_ms = ts_ms[fresh]
+            order = np.argsort(ts_ms, kind="stable")
+            ts_ms = ts_ms[order]
+            state = self.states.get(node)
+            if state is None:
+                state = self.states[node] = empty_state()
+            for mi, values in enumerate((pm25, pm10)):
+                s = state[mi].tolist()
+                update_metric(s, ts_ms, np.asarray(values, dtype=float)[fresh][order], METRICS[mi], new_events)
+                state[mi] = s
+            self.last_ts[node] = int(ts_ms[-1])
+            if new_events:
+                log = self.events.setdefault(node, deque(maxlen=MAX_EVENTS))
+                for event in sorted(new_events, key=lambda e: e["end"] or e["start"]):
+                    log.append({"node": node, **event})
+            self._dirty = True
+        return new_events
+
+    def status(self, node: str, since_ms: int | None = None) -> dict | None:
+        with self.lock:
+            state = self.states.get(node)
+            if state is None:
+                return None
+            events = [e for e in self.events.get(node, ()) if since_ms is None or (e["end"] or e["start"]) > since_ms]
+            return {**describe(state, self.last_ts[node]), "events": events}
+
+    def active(self) -> list[dict]:
+        with self.lock:
+            return [
+                {"node": node, **describe(state, self.last_ts[node])}
+                for node, state in self.states.items()
+                if (state[:, SPIKE_START] >= 0).any()
+            ]
+
+    def recent_events(self, since_ms: int | None = None, limit: int = 100) -> list[dict]:
+        with self.lock:
+            events = [e for log in self.events.values() for e in log if since_ms is None or (e["end"] or e["start"]) > since_ms]
+        events.sort(key=lambda e: e["end"] or e["start"], reverse=True)
+        return events[:limit]
+
+    def export(self) -> dict:
+        # JSON-able copy of the state, for workers that only read it
+        with self.lock:
+            return {
+                "states": {k: v.tolist() for k, v in self.states.items()},
+                "last_ts": dict(self.last_ts),
+                "events": {k: list(v) for k, v in self.events.items()},
+            }
+
+    def restore(self, data: dict) -> None:
+        states = {k: np.array(v, dtype=np.float64) for k, v in data["states"].items()}
+        events = {k: deque(v, maxlen=MAX_EVENTS) for k, v in data["events"].items()}
+        with self.lock:
+            self.states = states
+            self.last_ts = {k: int(v) for k, v in data["last_ts"].items()}
+            self.events = events
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self.lock:
+            if not self._dirty:
+                return
+            keys = sorted(self.states)
+            arrays = {
+                "keys": np.array(keys, dtype=str),
+                "states": np.array([self.states[k] for k in keys], dtype=np.float64).reshape(len(keys), len(METRICS), FIELDS),
+                "last_ts": np.array([self.last_ts[k] for k in keys], dtype=np.int64),
+                "events": np.array(json.dumps({k: list(v) for k, v in self.events.items()})),
+                "layout": np.array([len(METRICS), FIELDS], dtype=np.int64),
+            }
+            if self.position is not None:
+                arrays["poll_last_id"] = np.array(self.position[0], dtype=np.int64)
+                arrays["poll_seen"] = np.array(self.position[1], dtype=np.int64)
+            self._dirty = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp.npz")
+        np.savez_compressed(tmp, **arrays)
+        tmp.replace(self.path)
+
+    def load(self) -> None:
+        if not self.path or not self.path.exists():
+            return
+        data = np.load(self.path, allow_pickle=False)
+        if list(data["layout"]) != [len(METRICS), FIELDS]:
+            return
+        keys = [str(k) for k in data["keys"]]
+        self.restore(
+            {
+                "states": {k: data["states"][i] for i, k in enumerate(keys)},
+                "last_ts": {k: data["last_ts"][i] for i, k in enumerate(keys)},
+                "events": json.loads(str(data["events"])),
+            }
+        )
+        if "poll_last_id" in data.files:
+            self.position = (int(data["poll_last_id"]), data["poll_seen"].tolist())
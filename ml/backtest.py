@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import joblib
+import numpy as np
+import pandas as pd
+import db
+from features import BUCKET_MS, LAGS, bundle_problems
+from forecast import HOUR_MS, forecast_bounds, recursive_forecast
+
+HORIZONS = [1, 2, 3, 4, 5]
+# An origin counts only if /predict would have used the model there: at
+# least 2 * LAGS buckets (LAGS complete feature rows) in its data window.
+WINDOW_H = 6
+# /predict clamps forecasts to the q10/q90 of the node's 24h sketch
+# baseline; here the trailing 24 hours of 10-minute means stand in for it
+BASELINE_WINDOW = "24h"
+
+_worker_model = {}
+
+
+def load_buckets(start_ms: int | None, end_ms: int | None, node: str | None) -> pd.DataFrame:
+    where, params = [], []
+    if start_ms is not None:
+        where.append("timestamp >= %s")
+        params.append(start_ms)
+    if end_ms is not None:
+        where.append("timestamp < %s")
+        params.append(end_ms)
+    if node:
+        where.append("node = %s")
+        params.append(node)
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+    # 10-minute means computed by the DB, as features.bin_samples() does per request
+    query = (
+        f"SELECT node, timestamp / {BUCKET_MS} AS b, AVG(pm25), AVG(pm10) FROM sensor_data {clause} "
+        "GROUP BY node, timestamp / %s ORDER BY node, b"
+    )
+    with db.cursor() as cur:
+        cur.execute(db.sql(query), (*params, BUCKET_MS))
+        rows = cur.fetchall()
+    df = pd.DataFrame(rows, columns=["node", "bucket", "pm25", "pm10"])
+    df["bucket"] = df["bucket"].astype(np.int64) * BUCKET_MS
+    return df
+
+
+def backtest_node(node: str, frame: pd.DataFrame, model_path: str, stride: int) -> pd.DataFrame:
+    model = _worker_model.get(model_path)
+    if model is None:
+        model = _worker_model[model_path] = joblib.load(model_path)["model_pm25"]
+    b = frame["bucket"].to_numpy(dtype=np.int64)
+    p25 = frame["pm25"].to_numpy(dtype=np.float64)
+    p10 = frame["pm10"].to_numpy(dtype=np.float64)
+    first = 2 * LAGS - 1
+    if len(b) <= first:
+        return pd.DataFrame()
+    origins = np.arange(first, len(b), stride)
+    origins = origins[b[origins] - b[origins - first] < WINDOW_H * HOUR_MS]
+    if origins.size == 0:
+        return pd.DataFrame()
+
+    idx = origins[:, None] + np.arange(-LAGS, 1)[None, :]
+    raw = np.clip(recursive_forecast(model, p25[idx], p10[idx], b[origins], len(HORIZONS)), 5, 300)
+    # serve.postprocess_forecast, with the last 10-minute mean as "latest value"
+    trailing = pd.Series(p25, index=pd.to_datetime(b, unit="ms")).rolling(BASELINE_WINDOW)
+    q10 = trailing.quantile(0.1).to_numpy()[origins]
+    q90 = trailing.quantile(0.9).to_numpy()[origins]
+    lo, hi = forecast_bounds(p25[origins], q10, q90)
+    preds = np.clip(raw, lo[:, None], hi[:, None]).round(1)
+
+    # Actual: the 10-minute bucket h hours after the origin, when present
+    target = b[origins][:, None] + np.array(HORIZONS)[None, :] * HOUR_MS
+    pos = np.minimum(np.searchsorted(b, target), len(b) - 1)
+    actual = np.where(b[pos] == target, p25[pos], np.nan)
+
+    n = len(origins)
+    out = pd.DataFrame(
+        {
+            "node": node,
+            "origin": np.repeat(b[origins], len(HORIZONS)),
+            "horizon": np.tile(HORIZONS, n),
+            "forecast": preds.ravel(),
+            "forecast_raw": raw.ravel(),
+            "persistence": np.repeat(p25[origins], len(HORIZONS)),
+            "actual": actual.ravel(),
+        }
+    )
+    out = out[out["actual"].notna()]
+    out["target_hour"] = pd.to_datetime(out["origin"] + out["horizon"] * HOUR_MS, unit="ms", utc=True).dt.hour
+    return out
+
+
+def summarize(results: pd.DataFrame, by: list[str]) -> pd.DataFrame:
+    # forecast: what /predict returns (postprocessed); *_raw: model output
+    err = results["forecast"] - results["actual"]
+    raw_err = results["forecast_raw"] - results["actual"]
+    base = (results["persistence"] - results["actual"]).abs()
+    frame = results[by].assign(
+        abs_err=err.abs(), sq_err=err * err, err=err, raw_abs_err=raw_err.abs(), raw_sq_err=raw_err * raw_err, persist_abs_err=base
+    )
+    g = frame.groupby(by)
+    out = pd.DataFrame(
+        {
+            "n": g.size(),
+            "mae": g["abs_err"].mean(),
+            "rmse": np.sqrt(g["sq_err"].mean()),
+            "bias": g["err"].mean(),
+            "mae_raw": g["raw_abs_err"].mean(),
+            "rmse_raw": np.sqrt(g["raw_sq_err"].mean()),
+            "mae_persistence": g["persist_abs_err"].mean(),
+        }
+    )
+    out["skill"] = 1.0 - out["mae"] / out["mae_persistence"].replace(0, np.nan)
+    return out.round(3).reset_index()
+
+
+def run(model_path: Path, start_ms: int | None, end_ms: int | None, node: str | None, stride: int, jobs: int) -> pd.DataFrame:
+    buckets = load_buckets(start_ms, end_ms, node)
+    groups = [(str(k), g) for k, g in buckets.groupby("node", sort=True)]
+    if jobs <= 1 or len(groups) <= 1:
+        parts = [backtest_node(k, g, str(model_path), stride) for k, g in groups]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            parts = list(
+                pool.map(
+                    backtest_node,
+                    [k for k, _ in groups],
+                    [g for _, g in groups],
+                    [str(model_path)] * len(groups),
+                    [stride] * len(groups),
+                )
+            )
+    parts = [p for p in parts if not p.empty]
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+
+def parse_time(value: str | None) -> int | None:
+    if value is None:
+        return None
+    return int(pd.Timestamp(value, tz="UTC").timestamp() * 1000)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=None, help="SQLite (default: DATABASE_URL/SQLITE_PATH)")
+    parser.add_argument("--model", default="./models/air_quality_model.joblib")
+    parser.add_argument("--node", default=None)
+    parser.add_argument("--from", dest="start", default=None, help="es. 2025-01-01")
+    parser.add_argument("--to", dest="end", default=None)
+    parser.add_argument("--stride", type=int, default=1, help="un'origine ogni N bucket da 10 minuti")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--out", default=None, help="cartella per i CSV dei risultati")
+    args = parser.parse_args()
+
+    if args.db:
+        db.DB_URL = None
+        db.SQLITE_PATH = args.db
+    if not db.configured():
+        raise SystemExit("DATABASE_URL e SQLITE_PATH non impostate (oppure --db)")
+
+    problems = bundle_problems(joblib.load(args.model))
+    if problems:
+        raise SystemExit(f"Modello incompatibile con features.py: {'; '.join(problems)}")
+    started = time.perf_counter()
+    results = run(Path(args.model), parse_time(args.start), parse_time(args.end), args.node, args.stride, args.jobs)
+    if results.empty:
+        raise SystemExit("Nessuna origine valutabile nel periodo")
+    by_horizon = summarize(results, ["horizon"])
+    by_node = summarize(results, ["node", "horizon"])
+    by_hour = summarize(results, ["target_hour", "horizon"])
+
+    print(f"{results['origin'].nunique()} origini, {results['node'].nunique()} nodi, {time.perf_counter() - started:.1f}s")
+    print(by_horizon.to_string(index=False))
+    if args.out:
+        out = Path(args.out)
+        out.mkdir(parents=True, exist_ok=True)
+        by_horizon.to_csv(out / "by_horizon.csv", index=False)
+        by_node.to_csv(out / "by_node.csv", index=False)
+        by_hour.to_csv(out / "by_hour.csv", index=False)
+        (out / "summary.json").write_text(
+            json.dumps({"model": args.model, "from": args.start, "to": args.end, "stride": args.stride, "by_horizon": by_horizon.to_dict("records")}, indent=2)
+        )
+        print(f"risultati salvati in {out}")
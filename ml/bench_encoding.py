@@ -0,0 +1,81 @@
+import argparse
+import gzip
+import os
+import tempfile
+import time
+from pathlib import Path
+import orjson
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+from bench_serving import make_synthetic_db
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+COLUMNAR_TYPE = "application/vnd.airquality.columnar+json"
+
+
+def as_rows(payload: dict, tables: tuple[str, ...]) -> dict:
+    out = dict(payload)
+    for k in tables:
+        names = list(payload[k])
+        out[k] = [dict(zip(names, row)) for row in zip(*(payload[k][c] for c in names))]
+    return out
+
+
+def timed(fn, repeat: int) -> tuple[float, bytes]:
+    body = fn()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat * 1e6, body
+
+
+def encodings(payload: dict, tables: tuple[str, ...]) -> dict:
+    rows = as_rows(payload, tables)
+    out = {
+        # FastAPI default before: jsonable_encoder + json.dumps
+        "json (prima)": lambda: JSONResponse(jsonable_encoder(rows)).body,
+        "orjson": lambda: orjson.dumps(rows, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY),
+    }
+    if tables:
+        out["orjson colonne"] = lambda: orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        if msgpack is not None:
+            out["msgpack colonne"] = lambda: msgpack.packb(payload)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--points", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "bench.db"
+        make_synthetic_db(db_path, nodes=2, hours=24)
+        os.environ["SQLITE_PATH"] = str(db_path)
+        os.environ["SKETCH_PATH"] = str(Path(tmp) / "sketches.npz")
+        os.environ["ANOMALY_PATH"] = str(Path(tmp) / "anomaly.npz")
+        from fastapi.testclient import TestClient
+        import serve
+
+        with TestClient(serve.app) as client:
+            columnar = {"Accept": COLUMNAR_TYPE}
+            cases = [
+                ("/ai/history", client.get(f"/ai/history?node=node-01&points={args.points}", headers=columnar).json(), ("data",)),
+                ("/predict", client.get("/predict?node=node-01", headers=columnar).json(), ("pm25Predictions", "pm10Predictions")),
+                ("/ai/insights", client.get("/ai/insights?node=node-01").json(), ()),
+            ]
+            wire = client.get(f"/ai/history?node=node-01&points={args.points}", headers={"Accept-Encoding": "gzip"})
+            print(f"/ai/history via GZipMiddleware: Content-Encoding={wire.headers.get('content-encoding')}, {wire.headers.get('content-length')} B")
+
+    print(f"\n{'endpoint':<14} {'formato':<16} {'µs/risposta':>12} {'byte':>9} {'byte gzip':>10}")
+    for name, payload, tables in cases:
+        for label, fn in encodings(payload, tables).items():
+            us, body = timed(fn, args.repeat)
+            print(f"{name:<14} {label:<16} {us:>12.1f} {len(body):>9} {len(gzip.compress(body, 9)):>10}")
+    if msgpack is None:
+        print("\nmsgpack non installato: formato msgpack non misurato")
@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from pathlib import Path
+import numpy as np
+import db
+
+
+def make_synthetic_db(path: Path, nodes: int = 20, hours: float = 6.0, step_s: float = 10.0) -> None:
+    rng = np.random.default_rng(0)
+    db.DB_URL = None
+    db.SQLITE_PATH = str(path)
+    conn = db.connect()
+    db.ensure_schema(conn)
+    now_ms = int(time.time() * 1000)
+    n = int(hours * 3600 / step_s)
+    ts = now_ms - (np.arange(n)[::-1] * step_s * 1000).astype(np.int64)
+    rows = []
+    for i in range(nodes):
+        pm25 = np.clip(15 + np.cumsum(rng.normal(0, 0.5, n)), 1, 300)
+        pm10 = pm25 * rng.uniform(1.4, 2.2)
+        rows += [(f"node-{i:02d}", float(a), float(b), 41.0, 16.0, int(t)) for a, b, t in zip(pm25, pm10, ts)]
+    conn.executemany("INSERT INTO sensor_data (node, pm25, pm10, lat, lon, timestamp) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def child_pids(pid: int) -> list[int]:
+    out = []
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            fields = (entry / "stat").read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            out.append(int(entry.name))
+    return out
+
+
+def memory_kb(pid: int) -> dict:
+    # RSS counts shared pages in every worker, PSS splits them between sharers
+    mem = {"rss_kb": 0, "pss_kb": 0}
+    try:
+        for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines():
+            key, _, value = line.partition(":")
+            if key in ("Rss", "Pss"):
+                mem[f"{key.lower()}_kb"] = int(value.split()[0])
+    except OSError:
+        pass
+    return mem
+
+
+def drive(url: str, duration_s: float, concurrency: int) -> dict:
+    latencies: list[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration_s
+
+    def client():
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(url, timeout=30) as resp:
+                    resp.read()
+                ok = True
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    lat = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": round(len(latencies) / duration_s, 1),
+        "p50_ms": round(float(np.percentile(lat, 50)), 1),
+        "p95_ms": round(float(np.percentile(lat, 95)), 1),
+    }
+
+
+def wait_ready(base: str, timeout_s: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{base}/ai/metrics", timeout=2):
+                return
+        except Exception:
+            time.sleep(0.3)
+    raise RuntimeError("Server non raggiungibile")
+
+
+def run(workers: int, args, db_path: Path, state_dir: Path) -> dict:
+    base = f"http://127.0.0.1:{args.port}"
+    # Sketch/detector state of this run only, never next to a --db file
+    env = dict(
+        os.environ,
+        SQLITE_PATH=str(db_path),
+        SKETCH_PATH=str(state_dir / "sketches.npz"),
+        ANOMALY_PATH=str(state_dir / "anomaly.npz"),
+    )
+    env.pop("DATABASE_URL", None)
+    if not args.no_shared:
+        env["SHARED_CACHE_NAME"] = f"aq-bench-{os.getpid()}"
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "serve:app", "--port", str(args.port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=Path(__file__).parent,
+        env=env,
+    )
+    try:
+        wait_ready(base)
+        # Warm every worker (model load, shared buffer attach) before measuring
+        drive(f"{base}{args.path}", 3.0, workers * 2)
+        result = drive(f"{base}{args.path}", args.duration, args.concurrency)
+        pids = child_pids(proc.pid) if workers > 1 else [proc.pid]
+        mems = [memory_kb(p) for p in pids]
+        result.update(
+            {
+                "workers": workers,
+                "rss_per_worker_mb": round(np.mean([m["rss_kb"] for m in mems]) / 1024, 1),
+                "pss_per_worker_mb": round(np.mean([m["pss_kb"] for m in mems]) / 1024, 1),
+            }
+        )
+        return result
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+        if "SHARED_CACHE_NAME" in env:
+            # Segment and leader lock outlive the workers by design
+            Path("/dev/shm", env["SHARED_CACHE_NAME"]).unlink(missing_ok=True)
+            Path("/tmp", f"{env['SHARED_CACHE_NAME']}.lock").unlink(missing_ok=True)
+            Path("/tmp", f"{env['SHARED_CACHE_NAME']}.state.json").unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=None, help="file SQLite (default: dati sintetici)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--path", default="/predict?node=node-01")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--no-shared", action="store_true", help="senza SHARED_CACHE_NAME")
+    parser.add_argument("--out", default=None, help="salva i risultati in JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(args.db) if args.db else Path(tmp) / "bench.db"
+        if not args.db:
+            make_synthetic_db(db_path)
+        results = []
+        for w in args.workers:
+            state_dir = Path(tmp) / f"state-{w}"
+            state_dir.mkdir()
+            results.append(run(w, args, db_path, state_dir))
+
+    print(f"{'workers':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'RSS/w MB':>9} {'PSS/w MB':>9} {'errors':>6}")
+    for r in results:
+        print(
+            f"{r['workers']:>7} {r['rps']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+            f"{r['rss_per_worker_mb']:>9} {r['pss_per_worker_mb']:>9} {r['errors']:>6}"
+        )
+    if args.out:
+        Path(args.out).write_text(json.dumps(results, indent=2))
@@ -0,0 +1,85 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+import psycopg2
+
+DB_URL = os.getenv("DATABASE_URL")
+# Local runs without Postgres (same schema as backend/data/air_quality.db)
+SQLITE_PATH = os.getenv("SQLITE_PATH")
+PG_SSLMODE = os.getenv("PGSSLMODE", "require")
+
+SENSOR_COLUMNS = ["node", "pm25", "pm10", "lat", "lon", "timestamp"]
+
+
+def configured() -> bool:
+    return bool(DB_URL or SQLITE_PATH)
+
+
+def is_sqlite() -> bool:
+    return not DB_URL and bool(SQLITE_PATH)
+
+
+def connect():
+    if DB_URL:
+        return psycopg2.connect(DB_URL, sslmode=PG_SSLMODE)
+    if SQLITE_PATH:
+        return sqlite3.connect(SQLITE_PATH, timeout=30)
+    raise RuntimeError("DATABASE_URL e SQLITE_PATH non impostate")
+
+
+def sql(query: str) -> str:
+    # Queries are written with psycopg2 placeholders
+    return query.replace("%s", "?") if is_sqlite() else query
+
+
+@contextmanager
+def cursor(name: str | None = None):
+    conn = connect()
+    try:
+        # Named (server-side) cursors only exist on Postgres
+        cur = conn.cursor(name=name) if name and not is_sqlite() else conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def ensure_schema(conn) -> None:
+    cur = conn.cursor()
+    if is_sqlite():
+        cur.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sensor_data (
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              node TEXT NOT NULL,
+              pm25 REAL NOT NULL,
+              pm10 REAL NOT NULL,
+              lat REAL NOT NULL,
+              lon REAL NOT NULL,
+              timestamp INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_sensor_data_timestamp ON sensor_data(timestamp);
+            CREATE INDEX IF NOT EXISTS idx_sensor_data_node ON sensor_data(node);
+            """
+        )
+    else:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sensor_data (
+              id SERIAL PRIMARY KEY,
+              node TEXT NOT NULL,
+              pm25 REAL NOT NULL,
+              pm10 REAL NOT NULL,
+              lat REAL NOT NULL,
+              lon REAL NOT NULL,
+              timestamp BIGINT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_sensor_data_timestamp ON sensor_data(timestamp);
+            CREATE INDEX IF NOT EXISTS idx_sensor_data_node ON sensor_data(node);
+            """
+        )
+    cur.close()
+    conn.commit()
@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Bump when a feature's definition changes; stored in the model bundle and
+# checked by serve.py before the models are used.
+FEATURE_VERSION = 1
+BUCKET_MS = 10 * 60 * 1000
+LAGS = 6
+WINDOW = 6
+
+# Forecast models (pm25/pm10): one row per 10-minute bucket
+LAG_FEATURES = [f"{m}_lag_{i}" for i in range(1, LAGS + 1) for m in ("pm25", "pm10")] + [
+    "pm25_roll_3",
+    "pm25_roll_6",
+    "pm25_std_6",
+    "pm10_roll_3",
+    "pm10_roll_6",
+    "pm10_std_6",
+    "pm25_diff_1",
+    "pm10_diff_1",
+    "hour_of_day",
+    "day_of_week",
+]
+# Source and vulnerability models: one row per window of WINDOW buckets
+WINDOW_FEATURES = [
+    "pm25_last",
+    "pm10_last",
+    "ratio",
+    "delta",
+    "trend",
+    "volatility",
+    "avg_pm25",
+    "avg_pm10",
+    "max_pm25",
+    "min_pm25",
+    "spike",
+    "duration_min",
+]
+FEATURE_SCHEMA = {
+    "version": FEATURE_VERSION,
+    "bucket_ms": BUCKET_MS,
+    "lags": LAGS,
+    "window": WINDOW,
+    "lag_features": LAG_FEATURES,
+    "window_features": WINDOW_FEATURES,
+}
+# Bundle key -> feature list the model was fitted on
+MODEL_FEATURES = {
+    "model_pm25": LAG_FEATURES,
+    "model_pm10": LAG_FEATURES,
+    "model_source": WINDOW_FEATURES,
+    "model_vulnerability": WINDOW_FEATURES,
+}
+
+_HOUR_MS = 3600 * 1000
+_DAY_MS = 24 * _HOUR_MS
+
+
+def bin_groups(group: np.ndarray, ts_ms: np.ndarray, pm25: np.ndarray, pm10: np.ndarray):
+    # 10-minute bucket means per (group, bucket), sorted by group then bucket.
+    # group: small non-negative ints (e.g. node codes).
+    bucket = np.asarray(ts_ms, dtype=np.int64) // BUCKET_MS
+    key = np.asarray(group, dtype=np.int64) << 40 | bucket
+    keys, inverse, counts = np.unique(key, return_inverse=True, return_counts=True)
+    mean25 = np.bincount(inverse, weights=np.asarray(pm25, dtype=float), minlength=len(keys)) / counts
+    mean10 = np.bincount(inverse, weights=np.asarray(pm10, dtype=float), minlength=len(keys)) / counts
+    return keys >> 40, (keys & ((1 << 40) - 1)) * BUCKET_MS, mean25, mean10
+
+
+def bin_samples(ts_ms: np.ndarray, pm25: np.ndarray, pm10: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # 10-minute bucket means of one series, sorted by bucket start (ms)
+    _, bucket, mean25, mean10 = bin_groups(np.zeros(len(ts_ms), dtype=np.int64), ts_ms, pm25, pm10)
+    return bucket, mean25, mean10
+
+
+def bin_frame(df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    ts_ms = df["timestamp"].astype("int64").to_numpy() // 1_000_000
+    return bin_samples(ts_ms, df["pm25"].to_numpy(dtype=float), df["pm10"].to_numpy(dtype=float))
+
+
+def lag_block(w25: np.ndarray, w10: np.ndarray, bucket_ms: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    # w25/w10: (rows, LAGS + 1) windows, oldest first, last column is the
+    # row's own bucket. Rolling stats cover the LAGS previous buckets.
+    n = len(bucket_ms)
+    if out is None:
+        out = np.empty((n, len(LAG_FEATURES)), dtype=np.float64)
+    out[:, 0 : 2 * LAGS : 2] = w25[:, LAGS - 1 :: -1][:, :LAGS]
+    out[:, 1 : 2 * LAGS : 2] = w10[:, LAGS - 1 :: -1][:, :LAGS]
+    col = 2 * LAGS
+    for w in (w25, w10):
+        prev = w[:, :LAGS]
+        out[:, col] = prev[:, -3:].mean(axis=1)
+        out[:, col + 1] = prev.mean(axis=1)
+        out[:, col + 2] = prev.std(axis=1, ddof=1)
+        col += 3
+    out[:, col] = w25[:, -1] - w25[:, -2]
+    out[:, col + 1] = w10[:, -1] - w10[:, -2]
+    bucket_ms = np.asarray(bucket_ms, dtype=np.int64)
+    out[:, col + 2] = bucket_ms // _HOUR_MS % 24
+    # 1970-01-01 was a Thursday; Monday = 0 as in pandas
+    out[:, col + 3] = (bucket_ms // _DAY_MS + 3) % 7
+    return out
+
+
+def lag_features(bucket_ms: np.ndarray, pm25: np.ndarray, pm10: np.ndarray, start: int = LAGS) -> np.ndarray:
+    # Feature rows for buckets start..n-1 (the first LAGS have no full history)
+    start = max(start, LAGS)
+    n = len(bucket_ms)
+    if n <= start:
+        return np.empty((0, len(LAG_FEATURES)), dtype=np.float64)
+    w25 = sliding_window_view(np.asarray(pm25, dtype=float), LAGS + 1)[start - LAGS :]
+    w10 = sliding_window_view(np.asarray(pm10, dtype=float), LAGS + 1)[start - LAGS :]
+    return lag_block(w25, w10, bucket_ms[start:])
+
+
+def window_block(w25: np.ndarray, w10: np.ndarray, t0_ms: np.ndarray, t1_ms: np.ndarray) -> np.ndarray:
+    # w25/w10: (rows, k) windows of bucket means, oldest first
+    out = np.empty((len(w25), len(WINDOW_FEATURES)), dtype=np.float64)
+    last25, last10 = w25[:, -1], w10[:, -1]
+    duration = np.maximum((np.asarray(t1_ms) - np.asarray(t0_ms)) / 60_000.0, 1.0)
+    delta = last25 - w25[:, 0]
+    avg25 = w25.mean(axis=1)
+    max25 = w25.max(axis=1)
+    out[:, 0] = last25
+    out[:, 1] = last10
+    out[:, 2] = np.divide(last25, last10, out=np.zeros_like(last25), where=last10 > 0)
+    out[:, 3] = delta
+    out[:, 4] = delta / duration * 60.0
+    out[:, 5] = w25.std(axis=1, ddof=1) if w25.shape[1] > 1 else 0.0
+    out[:, 6] = avg25
+    out[:, 7] = w10.mean(axis=1)
+    out[:, 8] = max25
+    out[:, 9] = w25.min(axis=1)
+    out[:, 10] = max25 - avg25
+    out[:, 11] = duration
+    return out
+
+
+def window_features(bucket_ms: np.ndarray, pm25: np.ndarray, pm10: np.ndarray, window: int = WINDOW) -> np.ndarray:
+    # One row per full window ending at buckets window-1..n-1
+    if len(bucket_ms) < window:
+        return np.empty((0, len(WINDOW_FEATURES)), dtype=np.float64)
+    w25 = sliding_window_view(np.asarray(pm25, dtype=float), window)
+    w10 = sliding_window_view(np.asarray(pm10, dtype=float), window)
+    return window_block(w25, w10, bucket_ms[: len(bucket_ms) - window + 1], bucket_ms[window - 1 :])
+
+
+def last_windows(group: np.ndarray, bucket_ms: np.ndarray, pm25: np.ndarray, pm10: np.ndarray, window: int = WINDOW):
+    # Latest window of every group (rows sorted by group, bucket), shorter
+    # than `window` when a group has less history; groups with fewer than 2
+    # buckets are skipped. Returns (group, features), one row per group.
+    n = len(group)
+    if n == 0:
+        return np.empty(0, dtype=np.int64), np.empty((0, len(WINDOW_FEATURES)))
+    ends = np.flatnonzero(np.r_[group[1:] != group[:-1], True])
+    starts = np.r_[0, ends[:-1] + 1]
+    sizes = np.minimum(ends - starts + 1, window)
+    groups, blocks = [], []
+    # One block per distinct window length (at most `window` - 1 of them)
+    for k in np.unique(sizes[sizes >= 2]):
+        sel = ends[sizes == k]
+        idx = sel[:, None] + np.arange(1 - k, 1)[None, :]
+        blocks.append(window_block(pm25[idx], pm10[idx], bucket_ms[idx[:, 0]], bucket_ms[sel]))
+        groups.append(group[sel])
+    if not blocks:
+        return np.empty(0, dtype=np.int64), np.empty((0, len(WINDOW_FEATURES)))
+    return np.concatenate(groups), np.vstack(blocks)
+
+
+def last_window(bucket_ms: np.ndarray, pm25: np.ndarray, pm10: np.ndarray, window: int = WINDOW) -> np.ndarray | None:
+    _, X = last_windows(np.zeros(len(bucket_ms), dtype=np.int64), bucket_ms, pm25, pm10, window)
+    return X if len(X) else None
+
+
+def frame(X: np.ndarray, columns: list[str], model=None) -> pd.DataFrame:
+    # Models were fitted on DataFrames: keep the names, in the fitted order
+    df = pd.DataFrame(X, columns=columns)
+    names = getattr(model, "feature_names_in_", None)
+    if names is not None and list(names) != columns:
+        df = df[list(names)]
+    return df
+
+
+def bundle_schema(bundle: dict) -> dict:
+    # Bundles written before the schema existed used version 1
+    return bundle.get("feature_schema") or {"version": 1}
+
+
+def bundle_problems(bundle: dict) -> list[str]:
+    # A different version means the definitions changed and the models are
+    # not used; a different column order is adapted to by frame().
+    schema = bundle_schema(bundle)
+    problems = []
+    if schema.get("version") != FEATURE_VERSION:
+        problems.append(f"feature_schema v{schema.get('version')}, serve v{FEATURE_VERSION}")
+    for key, expected in MODEL_FEATURES.items():
+        names = getattr(bundle.get(key), "feature_names_in_", None)
+        if names is not None and set(names) != set(expected):
+            problems.append(f"{key}: feature diverse dallo schema")
+    return problems
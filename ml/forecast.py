@@ -0,0 +1,32 @@
+import numpy as np
+from features import LAG_FEATURES, frame, lag_block
+
+HOUR_MS = 3600 * 1000
+
+
+def recursive_forecast(model, w25: np.ndarray, w10: np.ndarray, t_ms: np.ndarray, steps: int, target: str = "pm25") -> np.ndarray:
+    # Multi-step forecast for a batch of origins (serve: one, backtest: all
+    # of a node). w25/w10: (origins, LAGS + 1) windows of 10-minute means,
+    # t_ms: their last bucket. Each step appends the prediction as a new
+    # bucket one hour later; the other pollutant is held at its last value.
+    w25 = np.array(w25, dtype=np.float64, ndmin=2)
+    w10 = np.array(w10, dtype=np.float64, ndmin=2)
+    t_ms = np.array(t_ms, dtype=np.int64, ndmin=1)
+    preds = np.empty((len(t_ms), steps), dtype=np.float64)
+    X = np.empty((len(t_ms), len(LAG_FEATURES)), dtype=np.float64)
+    for j in range(steps):
+        p = np.asarray(model.predict(frame(lag_block(w25, w10, t_ms, out=X), LAG_FEATURES, model)), dtype=np.float64)
+        preds[:, j] = p
+        w25 = np.column_stack([w25[:, 1:], p if target == "pm25" else w25[:, -1]])
+        w10 = np.column_stack([w10[:, 1:], p if target == "pm10" else w10[:, -1]])
+        t_ms = t_ms + HOUR_MS
+    return preds
+
+
+def forecast_bounds(base, q10, q90) -> tuple:
+    # Range a pm25 forecast is clamped to (serve.postprocess_forecast):
+    # base is the latest value, q10/q90 the 24h baseline or recent window.
+    # Scalars or arrays of origins.
+    lo = np.maximum(np.maximum(5.0, q10), np.multiply(base, 0.7))
+    hi = np.maximum(np.maximum(80.0, np.multiply(q90, 1.3)), np.multiply(base, 1.5))
+    return lo, hi
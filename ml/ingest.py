@@ -0,0 +1,233 @@
+import io
+import json
+import logging
+import os
+import queue
+import threading
+import zlib
+import numpy as np
+import pandas as pd
+import db
+
+INGEST_MAX_ROWS = int(os.getenv("INGEST_MAX_ROWS", "100000"))
+# Body size after decompression (the endpoint is unauthenticated)
+INGEST_MAX_BYTES = int(os.getenv("INGEST_MAX_BYTES", str(32 * 1024 * 1024)))
+INGEST_QUEUE_BATCHES = int(os.getenv("INGEST_QUEUE_BATCHES", "64"))
+INGEST_FLUSH_ROWS = 20_000
+INGEST_FLUSH_INTERVAL_S = 0.5
+PM25_RANGE = (0.0, 1000.0)
+PM10_RANGE = (0.0, 2000.0)
+# Accepted timestamps: from 2000-01-01 up to the arrival time plus some clock
+# skew; anything else would break the int64 columns or freeze the per-node
+# caches, which skip samples older than the newest one seen
+TS_MIN_MS = 946_684_800_000
+TS_MAX_SKEW_MS = int(os.getenv("INGEST_MAX_SKEW_MS", str(5 * 60 * 1000)))
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+logger = logging.getLogger("ingest")
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+def gunzip_limited(body: bytes, limit: int) -> bytes:
+    # gzip.decompress without a bound on the output; members are
+    # concatenated as gzip.decompress does
+    out = []
+    size = 0
+    while body:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            chunk = d.decompress(body, limit - size + 1)
+        except zlib.error as exc:
+            raise ValueError("Payload gzip non valido") from exc
+        size += len(chunk)
+        if size > limit:
+            raise PayloadTooLarge(f"Payload oltre {limit} byte decompresso")
+        if not d.eof:
+            raise ValueError("Payload gzip non valido")
+        out.append(chunk)
+        body = d.unused_data
+    return b"".join(out)
+
+
+def parse_payload(body: bytes, content_type: str | None = None, content_encoding: str | None = None) -> pd.DataFrame:
+    if len(body) > INGEST_MAX_BYTES:
+        raise PayloadTooLarge(f"Payload oltre {INGEST_MAX_BYTES} byte")
+    if (content_encoding or "").lower() == "gzip" or body[:2] == b"\x1f\x8b":
+        body = gunzip_limited(body, INGEST_MAX_BYTES)
+    if not body.strip():
+        return pd.DataFrame(columns=db.SENSOR_COLUMNS)
+
+    ctype = (content_type or "").split(";")[0].strip().lower()
+    try:
+        if ctype in NDJSON_TYPES:
+            return pd.read_json(io.BytesIO(body), lines=True, dtype=False, convert_dates=False)
+        payload = json.loads(body)
+    except ValueError as exc:
+        raise ValueError("JSON non valido") from exc
+
+    if isinstance(payload, list):
+        if not all(isinstance(item, dict) for item in payload):
+            raise ValueError("La lista deve contenere oggetti")
+        return pd.DataFrame.from_records(payload)
+    if not isinstance(payload, dict):
+        raise ValueError("Formato payload non supportato")
+    # Columnar arrays; scalars (node, lat, lon) are broadcast to every row
+    lengths = {len(v) for v in payload.values() if isinstance(v, list)}
+    if len(lengths) > 1:
+        raise ValueError("Colonne di lunghezza diversa")
+    try:
+        return pd.DataFrame(payload if lengths else [payload])
+    except (ValueError, TypeError) as exc:
+        # e.g. nested objects as column values
+        raise ValueError("Formato payload non supportato") from exc
+
+
+def validate_batch(df: pd.DataFrame, now_ms: int | None = None) -> tuple[pd.DataFrame, int]:
+    if df.empty:
+        return pd.DataFrame(columns=db.SENSOR_COLUMNS), 0
+    missing = [c for c in ("node", "pm25", "pm10", "lat", "lon") if c not in df.columns]
+    if missing:
+        raise ValueError(f"Dati mancanti: {', '.join(missing)}")
+    if now_ms is None:
+        now_ms = int(pd.Timestamp.utcnow().timestamp() * 1000)
+
+    node = df["node"].astype("string").str.strip()
+    pm25 = pd.to_numeric(df["pm25"], errors="coerce").to_numpy(dtype=float)
+    pm10 = pd.to_numeric(df["pm10"], errors="coerce").to_numpy(dtype=float)
+    lat = pd.to_numeric(df["lat"], errors="coerce").to_numpy(dtype=float)
+    lon = pd.to_numeric(df["lon"], errors="coerce").to_numpy(dtype=float)
+    if "timestamp" in df.columns:
+        # Missing timestamps get the arrival time; malformed ones are rejected
+        given = df["timestamp"].notna().to_numpy(dtype=bool)
+        ts = pd.to_numeric(df["timestamp"], errors="coerce").to_numpy(dtype=float)
+        bad_ts = given & np.isnan(ts)
+        ts = np.where(given, ts, now_ms)
+    else:
+        ts = np.full(len(df), now_ms, dtype=float)
+        bad_ts = np.zeros(len(df), dtype=bool)
+
+    ok = (node.notna() & (node != "")).to_numpy(dtype=bool)
+    ok &= (pm25 >= PM25_RANGE[0]) & (pm25 <= PM25_RANGE[1])
+    ok &= (pm10 >= PM10_RANGE[0]) & (pm10 <= PM10_RANGE[1])
+    ok &= (lat >= -90) & (lat <= 90) & (lon >= -180) & (lon <= 180)
+    ok &= ~bad_ts & (ts >= TS_MIN_MS) & (ts <= now_ms + TS_MAX_SKEW_MS)
+
+    clean = pd.DataFrame(
+        {
+            "node": node.to_numpy(dtype=object)[ok],
+            "pm25": pm25[ok],
+            "pm10": pm10[ok],
+            "lat": lat[ok],
+            "lon": lon[ok],
+            "timestamp": ts[ok].astype(np.int64),
+        }
+    )
+    return clean, int((~ok).sum())
+
+
+def write_rows(conn, df: pd.DataFrame) -> None:
+    rows = df[db.SENSOR_COLUMNS]
+    cur = conn.cursor()
+    try:
+        if db.is_sqlite():
+            cur.executemany(
+                "INSERT INTO sensor_data (node, pm25, pm10, lat, lon, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                rows.itertuples(index=False, name=None),
+            )
+        else:
+            buf = io.StringIO()
+            rows.to_csv(buf, index=False, header=False)
+            buf.seek(0)
+            cur.copy_expert(
+                "COPY sensor_data (node, pm25, pm10, lat, lon, timestamp) FROM STDIN WITH (FORMAT csv)",
+                buf,
+            )
+    finally:
+        cur.close()
+    conn.commit()
+
+
+class IngestWriter:
+    def __init__(self, max_batches: int = INGEST_QUEUE_BATCHES):
+        self.queue: queue.Queue = queue.Queue(maxsize=max_batches)
+        self.counts = {"accepted": 0, "rejected": 0, "throttled": 0, "written": 0, "failed": 0}
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    def count(self, key: str, n: int = 1) -> None:
+        with self.lock:
+            self.counts[key] += n
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {**self.counts, "queued_batches": self.queue.qsize()}
+
+    def start(self) -> None:
+        if self.thread and self.thread.is_alive():
+            return
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stop.set()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def submit(self, batch: pd.DataFrame) -> bool:
+        # Non-blocking: a full queue is reported to the caller as backpressure
+        try:
+            self.queue.put_nowait(batch)
+        except queue.Full:
+            self.count("throttled")
+            return False
+        self.count("accepted", len(batch))
+        return True
+
+    def _run(self) -> None:
+        conn = None
+        while not (self._stop.is_set() and self.queue.empty()):
+            try:
+                first = self.queue.get(timeout=INGEST_FLUSH_INTERVAL_S)
+            except queue.Empty:
+                continue
+            batches = [first]
+            rows = len(first)
+            while rows < INGEST_FLUSH_ROWS:
+                try:
+                    batch = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batches.append(batch)
+                rows += len(batch)
+            frame = pd.concat(batches, ignore_index=True) if len(batches) > 1 else first
+            conn = self._write(conn, frame)
+        if conn is not None:
+            conn.close()
+
+    def _write(self, conn, frame: pd.DataFrame):
+        for attempt in range(2):
+            try:
+                if conn is None:
+                    conn = db.connect()
+                    db.ensure_schema(conn)
+                write_rows(conn, frame)
+                break
+            except Exception:
+                logger.exception("Errore scrittura batch (%d righe), tentativo %d", len(frame), attempt + 1)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                conn = None
+        else:
+            self.count("failed", len(frame))
+            return conn
+
+        self.count("written", len(frame))
+        return conn
@@ -0,0 +1,321 @@
+import argparse
+import gzip
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import db
+from bench_serving import wait_ready
+from ingest import write_rows
+
+DEFAULT_MIX = "insights=5,predict=4,debug=1"
+RESULTS_DIR = Path(__file__).parent / "loadtest_results"
+REPLAY_TICK_S = 0.25
+
+
+def synthetic_stream(nodes: int, hours: float, step_s: float, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    n = int(hours * 3600 / step_s)
+    ts = (np.arange(n) * step_s * 1000).astype(np.int64)
+    frames = []
+    for i in range(nodes):
+        # Random walk with a daily cycle and occasional spikes
+        daily = 8 * np.sin(2 * np.pi * ts / 86_400_000 + rng.uniform(0, 2 * np.pi))
+        spikes = rng.exponential(40, n) * (rng.random(n) < 0.002)
+        pm25 = np.clip(18 + daily + np.cumsum(rng.normal(0, 0.3, n)) + spikes, 1, 500)
+        frames.append(
+            pd.DataFrame(
+                {
+                    "node": f"node-{i:02d}",
+                    "pm25": pm25.round(1),
+                    "pm10": (pm25 * rng.uniform(1.4, 2.2)).round(1),
+                    "lat": 41.0 + rng.normal(0, 0.01),
+                    "lon": 16.0 + rng.normal(0, 0.01),
+                    "timestamp": ts,
+                }
+            )
+        )
+    return pd.concat(frames, ignore_index=True).sort_values("timestamp", kind="stable", ignore_index=True)
+
+
+def recorded_stream(path: str, node: str | None = None) -> pd.DataFrame:
+    conn = sqlite3.connect(path)
+    try:
+        query = "SELECT node, pm25, pm10, lat, lon, timestamp FROM sensor_data"
+        params: tuple = ()
+        if node:
+            query += " WHERE node = ?"
+            params = (node,)
+        df = pd.read_sql_query(query + " ORDER BY timestamp ASC", conn, params=params)
+    finally:
+        conn.close()
+    if df.empty:
+        raise SystemExit(f"Nessun dato in {path}")
+    return df
+
+
+def parse_mix(spec: str) -> tuple[list[str], np.ndarray]:
+    names, weights = [], []
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ENDPOINTS:
+            raise SystemExit(f"Endpoint sconosciuto nel mix: {name}")
+        names.append(name.strip())
+        weights.append(float(weight or 1))
+    w = np.array(weights)
+    return names, w / w.sum()
+
+
+ENDPOINTS = {
+    "insights": lambda node: f"/ai/insights?node={node}",
+    "predict": lambda node: f"/predict?node={node}",
+    "debug": lambda node: "/ai/debug",
+}
+
+
+class Replayer:
+    # Writes the stream at `speed` x real time; each row is stamped with the
+    # wall-clock time it is written at, so the data stays "recent".
+    def __init__(self, stream: pd.DataFrame, speed: float, ingest_url: str | None = None):
+        self.stream = stream
+        self.speed = speed
+        self.ingest_url = ingest_url
+        self.stats = {"rows": 0, "batches": 0, "errors": 0, "max_lag_s": 0.0}
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="replay", daemon=True)
+
+    def _send(self, batch: pd.DataFrame, conn) -> None:
+        if self.ingest_url is None:
+            write_rows(conn, batch)
+            return
+        body = gzip.compress(batch.to_json(orient="records").encode())
+        req = urllib.request.Request(
+            self.ingest_url,
+            data=body,
+            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+        )
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            resp.read()
+
+    def _run(self) -> None:
+        conn = None if self.ingest_url else db.connect()
+        offsets = (self.stream["timestamp"].to_numpy() - int(self.stream["timestamp"].iloc[0])) / 1000.0 / self.speed
+        started = time.monotonic()
+        pos = 0
+        try:
+            while pos < len(offsets) and not self.stop.is_set():
+                elapsed = time.monotonic() - started
+                end = int(np.searchsorted(offsets, elapsed, side="right"))
+                if end > pos:
+                    batch = self.stream.iloc[pos:end].copy()
+                    # Wall-clock time, keeping the rows' (sped-up) spacing
+                    now_ms = time.time() * 1000
+                    batch["timestamp"] = (now_ms - (offsets[end - 1] - offsets[pos:end]) * 1000).astype(np.int64)
+                    try:
+                        self._send(batch, conn)
+                        self.stats["rows"] += len(batch)
+                        self.stats["batches"] += 1
+                    except Exception:
+                        self.stats["errors"] += 1
+                    self.stats["max_lag_s"] = max(self.stats["max_lag_s"], round(elapsed - offsets[pos], 3))
+                    pos = end
+                self.stop.wait(REPLAY_TICK_S)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+def prefill(stream: pd.DataFrame, now_ms: int) -> None:
+    # History for the endpoints: shifted so that it ends now
+    shifted = stream.copy()
+    shifted["timestamp"] = shifted["timestamp"] - int(shifted["timestamp"].iloc[-1]) + now_ms
+    conn = db.connect()
+    try:
+        db.ensure_schema(conn)
+        write_rows(conn, shifted)
+    finally:
+        conn.close()
+
+
+def drive_mix(base: str, names: list[str], probs: np.ndarray, nodes: list[str], clients: int, duration_s: float, think_ms: float) -> dict:
+    latencies: dict[str, list[float]] = {n: [] for n in names}
+    errors: dict[str, dict[str, int]] = {n: {} for n in names}
+    degraded = {n: 0 for n in names}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration_s
+
+    def client(seed: int):
+        rnd = random.Random(seed)
+        cum = np.cumsum(probs)
+        while time.monotonic() < stop_at:
+            name = names[min(int(np.searchsorted(cum, rnd.random(), side="right")), len(names) - 1)]
+            url = base + ENDPOINTS[name](rnd.choice(nodes))
+            started = time.perf_counter()
+            status, was_degraded = "ok", False
+            try:
+                with urllib.request.urlopen(url, timeout=60) as resp:
+                    payload = resp.read()
+                was_degraded = b'"degraded":[]' not in payload and b'"degraded":' in payload
+            except urllib.error.HTTPError as exc:
+                status = str(exc.code)
+            except Exception as exc:
+                status = type(exc).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                if status == "ok":
+                    latencies[name].append(elapsed)
+                    degraded[name] += was_degraded
+                else:
+                    errors[name][status] = errors[name].get(status, 0) + 1
+            if think_ms > 0:
+                time.sleep(rnd.expovariate(1000.0 / think_ms))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    report = {}
+    for name in names:
+        lat = np.array(latencies[name]) * 1000
+        n_err = sum(errors[name].values())
+        total = len(lat) + n_err
+        p50, p95, p99 = np.percentile(lat, [50, 95, 99]) if len(lat) else (np.nan, np.nan, np.nan)
+        report[name] = {
+            "requests": total,
+            "ok": len(lat),
+            "rps": round(len(lat) / duration_s, 2),
+            "error_rate": round(n_err / total, 4) if total else 0.0,
+            "errors": errors[name],
+            "degraded": degraded[name],
+            "p50_ms": round(float(p50), 1),
+            "p95_ms": round(float(p95), 1),
+            "p99_ms": round(float(p99), 1),
+            "max_ms": round(float(lat.max()), 1) if len(lat) else None,
+        }
+    return report
+
+
+def git_revision() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_report(result: dict, baseline: dict | None = None) -> None:
+    print(f"{'endpoint':>10} {'req':>6} {'req/s':>7} {'err %':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, r in result["endpoints"].items():
+        line = (
+            f"{name:>10} {r['requests']:>6} {r['rps']:>7} {100 * r['error_rate']:>6.1f} "
+            f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8}"
+        )
+        prev = (baseline or {}).get("endpoints", {}).get(name)
+        if prev:
+            deltas = [
+                f"{key[:3]} {100 * (r[key] - prev[key]) / prev[key]:+.0f}%"
+                for key in ("rps", "p50_ms", "p95_ms", "p99_ms")
+                if prev.get(key)
+            ]
+            line += "   vs base: " + ", ".join(deltas)
+        print(line)
+    rep = result["replay"]
+    print(f"replay: {rep['rows']} righe in {rep['batches']} lotti, errori {rep['errors']}, ritardo max {rep['max_lag_s']}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replay", default=None, help="SQLite registrato da riprodurre (default: flusso sintetico)")
+    parser.add_argument("--replay-node", default=None)
+    parser.add_argument("--nodes", type=int, default=10, help="nodi del flusso sintetico")
+    parser.add_argument("--stream-hours", type=float, default=30.0, help="durata del flusso sintetico")
+    parser.add_argument("--step", type=float, default=10.0, help="secondi tra campioni (sintetico)")
+    parser.add_argument("--prefill-hours", type=float, default=24.0)
+    parser.add_argument("--speed", type=float, default=60.0, help="velocità di replay (x tempo reale)")
+    parser.add_argument("--db", default=None, help="SQLite di destinazione (default: file temporaneo)")
+    parser.add_argument(
+        "--target-db", action="store_true", help="scrive i dati sintetici nel DB configurato (DATABASE_URL/SQLITE_PATH)"
+    )
+    parser.add_argument("--url", default=None, help="server già avviato (default: avvia uvicorn)")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--via-ingest", action="store_true", help="replay tramite POST /ingest invece che sul DB")
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--think-ms", type=float, default=0.0)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--out", default=None, help="file JSON risultati (default: loadtest_results/<ora>.json)")
+    parser.add_argument("--compare", default=None, help="JSON di un run precedente")
+    args = parser.parse_args()
+
+    names, probs = parse_mix(args.mix)
+    tmp = tempfile.TemporaryDirectory()
+    if args.url and not args.target_db:
+        raise SystemExit("Con --url il server legge il suo DB: serve --target-db")
+    if args.target_db and not db.configured():
+        raise SystemExit("--target-db: DATABASE_URL e SQLITE_PATH non impostate")
+    if not args.target_db:
+        db.DB_URL = None
+        db.SQLITE_PATH = args.db or str(Path(tmp.name) / "loadtest.db")
+
+    stream = recorded_stream(args.replay, args.replay_node) if args.replay else synthetic_stream(args.nodes, args.stream_hours, args.step)
+    ts = stream["timestamp"].to_numpy()
+    split = int(np.searchsorted(ts, ts[0] + args.prefill_hours * 3600 * 1000))
+    prefill(stream.iloc[:split], int(time.time() * 1000))
+    nodes = sorted(stream["node"].unique().tolist())
+
+    proc = None
+    base = args.url.rstrip("/") if args.url else f"http://127.0.0.1:{args.port}"
+    if not args.url:
+        env = {k: v for k, v in os.environ.items() if k not in ("DATABASE_URL", "SQLITE_PATH")}
+        if db.DB_URL:
+            env["DATABASE_URL"] = db.DB_URL
+        else:
+            env["SQLITE_PATH"] = db.SQLITE_PATH
+        env.setdefault("SKETCH_PATH", str(Path(tmp.name) / "sketches.npz"))
+        env.setdefault("ANOMALY_PATH", str(Path(tmp.name) / "anomaly.npz"))
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "serve:app", "--port", str(args.port), "--workers", str(args.workers), "--log-level", "warning"],
+            cwd=Path(__file__).parent,
+            env=env,
+        )
+
+    try:
+        wait_ready(base)
+        replayer = Replayer(stream.iloc[split:].reset_index(drop=True), args.speed, f"{base}/ingest" if args.via_ingest else None)
+        replayer.thread.start()
+        endpoints = drive_mix(base, names, probs, nodes, args.clients, args.duration, args.think_ms)
+        replayer.stop.set()
+        replayer.thread.join(30)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+        tmp.cleanup()
+
+    result = {
+        "started_at": pd.Timestamp.utcnow().isoformat(),
+        "revision": git_revision(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "endpoints": endpoints,
+        "replay": replayer.stats,
+    }
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    print_report(result, baseline)
+
+    out = Path(args.out) if args.out else RESULTS_DIR / f"{pd.Timestamp.utcnow():%Y%m%dT%H%M%S}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, indent=2))
+    print(f"risultati salvati in {out}")
@@ -0,0 +1,162 @@
+import contextvars
+import cProfile
+import functools
+import hmac
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from urllib.parse import parse_qs
+
+# Profiling is off unless a token is configured; requests opt in with
+# the X-Profile-Token header or ?profile=<token>.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", "./profiles"))
+PROFILE_MAX_PER_MIN = float(os.getenv("PROFILE_MAX_PER_MIN", "6"))
+PROFILE_KEEP = 50
+PROFILE_TOP = 40
+SAMPLE_INTERVAL_S = 0.001
+
+active = contextvars.ContextVar("active_profile", default=None)
+
+
+def authorized(token: str | None) -> bool:
+    return bool(PROFILE_TOKEN and token and hmac.compare_digest(token, PROFILE_TOKEN))
+
+
+class RateLimiter:
+    def __init__(self, per_minute: float):
+        self.capacity = max(per_minute, 1.0)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            return True
+
+
+class RequestProfile:
+    def __init__(self, path: str, tags: dict, limiter: RateLimiter):
+        self.id = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{time.monotonic_ns() % 1_000_000:06d}"
+        self.path = path
+        self.tags = tags
+        self.limiter = limiter
+        self.ran = False
+        self.elapsed_ms = 0.0
+        self.summary = ""
+        self.stacks: Counter = Counter()
+
+    def _sample(self, ident: int, stop: threading.Event) -> None:
+        # Wall-clock stack sampler for the thread running the endpoint;
+        # the output is collapsed stacks (flamegraph.pl / speedscope).
+        while not stop.wait(SAMPLE_INTERVAL_S):
+            frame = sys._current_frames().get(ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def run(self, fn, args, kwargs):
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample, args=(threading.get_ident(), stop), daemon=True)
+        profiler = cProfile.Profile()
+        sampler.start()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            self.elapsed_ms = (time.perf_counter() - started) * 1000.0
+            stop.set()
+            sampler.join()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP)
+            self.summary = out.getvalue()
+            self.ran = True
+
+    def save(self, directory: Path = PROFILE_DIR) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        header = [f"# {self.path} {self.elapsed_ms:.1f} ms"] + [f"# {k}: {v}" for k, v in sorted(self.tags.items())]
+        (directory / f"{self.id}.txt").write_text("\n".join(header) + "\n\n" + self.summary)
+        (directory / f"{self.id}.folded").write_text("".join(f"{s} {n}\n" for s, n in self.stacks.items()))
+        old = sorted(directory.glob("*.txt"))[:-PROFILE_KEEP]
+        for path in old:
+            path.unlink(missing_ok=True)
+            path.with_suffix(".folded").unlink(missing_ok=True)
+
+
+def profiled(fn):
+    # Endpoints run in the threadpool and cProfile only sees the thread it
+    # was enabled in, so the profile is started here rather than in the
+    # middleware. Unprofiled requests pay one ContextVar lookup. The rate
+    # limit is only spent here, so token-carrying requests to other paths
+    # (e.g. /ai/profiles) do not use it up.
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        prof = active.get()
+        if prof is None or not prof.limiter.allow():
+            return fn(*args, **kwargs)
+        return prof.run(fn, args, kwargs)
+
+    return wrapper
+
+
+def tag(**tags) -> None:
+    prof = active.get()
+    if prof is not None:
+        prof.tags.update(tags)
+
+
+class ProfileMiddleware:
+    # Plain ASGI middleware; only installed when PROFILE_TOKEN is set.
+    def __init__(self, app, tags=None):
+        self.app = app
+        self.tags = tags
+        self.limiter = RateLimiter(PROFILE_MAX_PER_MIN)
+
+    def _token(self, scope) -> str | None:
+        for key, value in scope["headers"]:
+            if key == b"x-profile-token":
+                return value.decode("latin-1")
+        query = scope.get("query_string", b"")
+        if b"profile=" in query:
+            return parse_qs(query.decode("latin-1")).get("profile", [None])[0]
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not authorized(self._token(scope)):
+            await self.app(scope, receive, send)
+            return
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        prof = RequestProfile(scope["path"], {"node": query.get("node", [None])[0]}, self.limiter)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start" and prof.ran:
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", prof.id.encode())]
+            await send(message)
+
+        reset = active.set(prof)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            active.reset(reset)
+            if prof.ran:
+                if self.tags is not None:
+                    prof.tags.update(self.tags())
+                prof.save()
@@ -0,0 +1,411 @@
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+import db
+
+# (name, bucket width ms, table), finest first
+ROLLUP_TIERS = [
+    ("10m", 10 * 60 * 1000, "sensor_rollup_10m"),
+    ("1h", 3600 * 1000, "sensor_rollup_1h"),
+    ("1d", 24 * 3600 * 1000, "sensor_rollup_1d"),
+]
+# Raw rows younger than this are left to the next refresh (late samples)
+ROLLUP_GRACE_MS = int(os.getenv("ROLLUP_GRACE_MS", str(2 * 60 * 1000)))
+# How far past a raw segment to look for the next sample of a node when
+# the query is not restricted to one node
+ROLLUP_LOOKAHEAD_MS = 3600 * 1000
+# rollup_state key holding the highest sensor_data.id already rolled up;
+# newer ids mark rows that arrived after their buckets were rolled
+LAST_ID_KEY = "last_id"
+
+AGG_COLUMNS = [
+    "samples",
+    "pm25_sum",
+    "pm25_sumsq",
+    "pm25_min",
+    "pm25_max",
+    "pm10_sum",
+    "pm10_sumsq",
+    "pm10_min",
+    "pm10_max",
+    # Left-point integral of pm25 over the gap to the node's next sample
+    # (µg/m³·ms) and the summed gaps, as in exposure_metrics()
+    "pm25_area",
+    "duration_ms",
+    "ts_min",
+    "ts_max",
+]
+_MIN_COLS = {"pm25_min", "pm10_min", "ts_min"}
+_MAX_COLS = {"pm25_max", "pm10_max", "ts_max"}
+
+RAW_AGG = (
+    "COUNT(*), SUM(pm25), SUM(pm25 * pm25), MIN(pm25), MAX(pm25), "
+    "SUM(pm10), SUM(pm10 * pm10), MIN(pm10), MAX(pm10), "
+    "SUM(pm25 * dt), SUM(dt), MIN(timestamp), MAX(timestamp)"
+)
+TIER_AGG = ", ".join(
+    f"{'MIN' if c in _MIN_COLS else 'MAX' if c in _MAX_COLS else 'SUM'}({c})" for c in AGG_COLUMNS
+)
+ROLLUP_COLUMNS = ", ".join(["node", "bucket"] + AGG_COLUMNS)
+UPSERT = "ON CONFLICT (node, bucket) DO UPDATE SET " + ", ".join(f"{c} = excluded.{c}" for c in AGG_COLUMNS)
+
+
+def raw_with_gaps(where: str) -> str:
+    return (
+        "SELECT node, pm25, pm10, timestamp, "
+        "COALESCE(LEAD(timestamp) OVER (PARTITION BY node ORDER BY timestamp) - timestamp, 0) AS dt "
+        f"FROM sensor_data WHERE {where}"
+    )
+
+
+def tier_by_name(name: str) -> tuple[str, int, str]:
+    return next(t for t in ROLLUP_TIERS if t[0] == name)
+
+
+def ensure_rollup_schema(cur) -> None:
+    value_cols = ", ".join(
+        f"{c} {'BIGINT' if c in ('samples', 'ts_min', 'ts_max') else 'DOUBLE PRECISION'} NOT NULL"
+        for c in AGG_COLUMNS
+    )
+    for _, _, table in ROLLUP_TIERS:
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            f"node TEXT NOT NULL, bucket BIGINT NOT NULL, {value_cols}, "
+            "PRIMARY KEY (node, bucket))"
+        )
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_bucket ON {table}(bucket)")
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS rollup_state (tier TEXT PRIMARY KEY, rolled_until BIGINT NOT NULL)"
+    )
+
+
+def load_state(cur) -> dict[str, int]:
+    cur.execute("SELECT tier, rolled_until FROM rollup_state")
+    return {tier: int(until) for tier, until in cur.fetchall()}
+
+
+def save_state(cur, key: str, value: int) -> None:
+    cur.execute(
+        db.sql(
+            "INSERT INTO rollup_state (tier, rolled_until) VALUES (%s, %s) "
+            "ON CONFLICT (tier) DO UPDATE SET rolled_until = excluded.rolled_until"
+        ),
+        (key, value),
+    )
+
+
+def roll_range(cur, tier: int, start: int, until: int, node: str | None = None) -> None:
+    # (Re)compute the tier's buckets in [start, until); existing rows are
+    # replaced, so rolling a range twice is harmless.
+    _, width, table = ROLLUP_TIERS[tier]
+    node_filter = "node = %s AND " if node else ""
+    node_params = [node] if node else []
+    if tier == 0:
+        # Raw rows, gaps computed with every newer row available so
+        # buckets at the edge are complete
+        source = f"({raw_with_gaps(node_filter + 'timestamp >= %s')}) s WHERE timestamp < %s"
+        bucket, agg = "timestamp", RAW_AGG
+    else:
+        source = f"{ROLLUP_TIERS[tier - 1][2]} WHERE {node_filter}bucket >= %s AND bucket < %s"
+        bucket, agg = "bucket", TIER_AGG
+    cur.execute(
+        db.sql(
+            f"INSERT INTO {table} ({ROLLUP_COLUMNS}) "
+            f"SELECT node, ({bucket} / %s) * %s, {agg} FROM {source} "
+            f"GROUP BY node, ({bucket} / %s) * %s {UPSERT}"
+        ),
+        [width, width, *node_params, start, until, width, width],
+    )
+
+
+def stale_buckets(cur, last_id: int, max_id: int) -> dict[str, int]:
+    # Earliest finest-tier bucket per node that rows written since the last
+    # refresh invalidated: a late row behind the rolled edge, or the node's
+    # previous sample, whose gap was computed before its next sample existed
+    # (0 after an outage, too long before a late row).
+    _, width, table = ROLLUP_TIERS[0]
+    cur.execute(
+        db.sql(
+            "SELECT n.node, n.first, "
+            f"(SELECT MAX(r.bucket) FROM {table} r WHERE r.node = n.node AND r.ts_min < n.first) "
+            "FROM (SELECT node, MIN(timestamp) AS first FROM sensor_data "
+            "WHERE id > %s AND id <= %s GROUP BY node) n"
+        ),
+        (last_id, max_id),
+    )
+    out = {}
+    for node, first, prev in cur.fetchall():
+        since = int(first) if prev is None else min(int(first), int(prev))
+        out[node] = (since // width) * width
+    return out
+
+
+def refresh_rollups(cur, now_ms: int | None = None) -> dict[str, int]:
+    if now_ms is None:
+        now_ms = int(pd.Timestamp.utcnow().timestamp() * 1000)
+    rolled = load_state(cur)
+    cur.execute("SELECT MAX(id) FROM sensor_data")
+    max_id = cur.fetchone()[0]
+    if max_id is None:
+        return rolled
+    stale = {}
+    if LAST_ID_KEY in rolled and ROLLUP_TIERS[0][0] in rolled:
+        stale = stale_buckets(cur, rolled[LAST_ID_KEY], int(max_id))
+    for i, (name, width, table) in enumerate(ROLLUP_TIERS):
+        start = rolled.get(name)
+        if i == 0:
+            # Finest tier: closed buckets of raw data
+            until = ((now_ms - ROLLUP_GRACE_MS) // width) * width
+            if start is None:
+                cur.execute("SELECT MIN(timestamp) FROM sensor_data")
+                start = (int(cur.fetchone()[0]) // width) * width
+        else:
+            prev_name, _, prev_table = ROLLUP_TIERS[i - 1]
+            if prev_name not in rolled:
+                break
+            # Only coarse buckets fully covered by the finer tier
+            until = (rolled[prev_name] // width) * width
+            if start is None:
+                cur.execute(f"SELECT MIN(bucket) FROM {prev_table}")
+                first = cur.fetchone()[0]
+                if first is None:
+                    break
+                start = (int(first) // width) * width
+        if name in rolled:
+            for node, since in stale.items():
+                since = (since // width) * width
+                if since < start:
+                    roll_range(cur, i, since, start, node)
+        if until > start:
+            roll_range(cur, i, start, until)
+        rolled[name] = max(until, start)
+        save_state(cur, name, rolled[name])
+    rolled[LAST_ID_KEY] = int(max_id)
+    save_state(cur, LAST_ID_KEY, rolled[LAST_ID_KEY])
+    return rolled
+
+
+def plan_segments(
+    from_ms: int, to_ms: int, rolled: dict[str, int], tiers: list | None = None
+) -> list[tuple[str | None, int, int]]:
+    # Coarsest tier for the aligned interior, finer tiers (then raw rows)
+    # for the edges and for whatever has not been rolled up yet.
+    if tiers is None:
+        tiers = ROLLUP_TIERS[::-1]
+    if from_ms >= to_ms:
+        return []
+    for i, (name, width, _) in enumerate(tiers):
+        start = -(-from_ms // width) * width
+        end = (min(to_ms, rolled.get(name, 0)) // width) * width
+        if end > start:
+            finer = tiers[i + 1 :]
+            return (
+                plan_segments(from_ms, start, rolled, finer)
+                + [(name, start, end)]
+                + plan_segments(end, to_ms, rolled, finer)
+            )
+    return [(None, from_ms, to_ms)]
+
+
+def _segment_query(source: str | None, node: str | None, a: int, b: int) -> tuple[str, list]:
+    if source is not None:
+        _, _, table = tier_by_name(source)
+        where = "bucket >= %s AND bucket < %s"
+        params: list = [a, b]
+        if node:
+            where = "node = %s AND " + where
+            params = [node] + params
+        return f"SELECT {TIER_AGG} FROM {table} WHERE {where}", params
+    if node:
+        # Include the node's first sample at/after b so the last gap is known
+        inner = raw_with_gaps(
+            "node = %s AND timestamp >= %s AND timestamp <= "
+            "COALESCE((SELECT MIN(timestamp) FROM sensor_data WHERE node = %s AND timestamp >= %s), %s)"
+        )
+        params = [node, a, node, b, b, b]
+    else:
+        inner = raw_with_gaps("timestamp >= %s AND timestamp < %s")
+        params = [a, b + ROLLUP_LOOKAHEAD_MS, b]
+    return f"SELECT {RAW_AGG} FROM ({inner}) s WHERE timestamp < %s", params
+
+
+def combine(parts: list[tuple]) -> dict:
+    out = {c: None for c in AGG_COLUMNS}
+    for part in parts:
+        for c, v in zip(AGG_COLUMNS, part):
+            if v is None:
+                continue
+            v = float(v)
+            if out[c] is None:
+                out[c] = v
+            elif c in _MIN_COLS:
+                out[c] = min(out[c], v)
+            elif c in _MAX_COLS:
+                out[c] = max(out[c], v)
+            else:
+                out[c] += v
+    return out
+
+
+def window_stats(cur, node: str | None, from_ms: int, to_ms: int, rolled: dict[str, int] | None = None) -> dict:
+    if rolled is None:
+        rolled = load_state(cur)
+    parts = []
+    for source, a, b in plan_segments(from_ms, to_ms, rolled):
+        query, params = _segment_query(source, node, a, b)
+        cur.execute(db.sql(query), params)
+        parts.append(cur.fetchone())
+    agg = combine(parts)
+    samples = int(agg["samples"] or 0)
+    stats = {"samples": samples, "ts_min": agg["ts_min"], "ts_max": agg["ts_max"]}
+    for m in ("pm25", "pm10"):
+        if samples == 0:
+            stats.update({f"{m}_mean": 0.0, f"{m}_std": 0.0, f"{m}_min": None, f"{m}_max": None})
+            continue
+        mean = agg[f"{m}_sum"] / samples
+        var = (agg[f"{m}_sumsq"] - samples * mean * mean) / (samples - 1) if samples > 1 else 0.0
+        stats[f"{m}_mean"] = mean
+        stats[f"{m}_std"] = float(np.sqrt(max(var, 0.0)))
+        stats[f"{m}_min"] = agg[f"{m}_min"]
+        stats[f"{m}_max"] = agg[f"{m}_max"]
+    duration_h = (agg["duration_ms"] or 0.0) / 3_600_000.0
+    stats["exposure"] = (agg["pm25_area"] or 0.0) / 3_600_000.0
+    stats["exposure_hours"] = duration_h
+    stats["exposure_avg"] = stats["exposure"] / duration_h if duration_h > 0 else 0.0
+    return stats
+
+
+def tier_for_width(width_ms: int) -> str:
+    # Coarsest tier whose buckets still fit in the requested resolution
+    name = ROLLUP_TIERS[0][0]
+    for tier, width, _ in ROLLUP_TIERS:
+        if width <= width_ms:
+            name = tier
+    return name
+
+
+def bucket_series(
+    cur, node: str | None, from_ms: int, to_ms: int, tier: str, rolled: dict[str, int] | None = None
+) -> pd.DataFrame:
+    if rolled is None:
+        rolled = load_state(cur)
+    _, width, table = tier_by_name(tier)
+    start = (from_ms // width) * width
+    split = max(start, min(to_ms, (rolled.get(tier, 0) // width) * width))
+    node_filter = " AND node = %s" if node else ""
+    rows = []
+    if split > start:
+        cur.execute(
+            db.sql(
+                "SELECT bucket, SUM(pm25_sum) / SUM(samples), SUM(pm10_sum) / SUM(samples) "
+                f"FROM {table} WHERE bucket >= %s AND bucket < %s{node_filter} "
+                "GROUP BY bucket ORDER BY bucket ASC"
+            ),
+            [start, split] + ([node] if node else []),
+        )
+        rows += cur.fetchall()
+    if to_ms >= split:
+        # Not rolled up yet: aggregate the raw tail the same way
+        cur.execute(
+            db.sql(
+                "SELECT (timestamp / %s) * %s AS bucket, AVG(pm25), AVG(pm10) "
+                f"FROM sensor_data WHERE timestamp >= %s AND timestamp <= %s{node_filter} "
+                "GROUP BY bucket ORDER BY bucket ASC"
+            ),
+            [width, width, split, to_ms] + ([node] if node else []),
+        )
+        rows += cur.fetchall()
+    df = pd.DataFrame(rows, columns=["timestamp", "pm25", "pm10"])
+    df["timestamp"] = df["timestamp"].astype("int64")
+    df[["pm25", "pm10"]] = df[["pm25", "pm10"]].astype(float)
+    return df
+
+
+def verify(cur, windows: int = 50, seed: int = 0) -> list[str]:
+    # Compare every tier and a set of random windows against raw data
+    errors = []
+    cur.execute("SELECT node, pm25, pm10, timestamp FROM sensor_data ORDER BY node, timestamp")
+    raw = pd.DataFrame(cur.fetchall(), columns=["node", "pm25", "pm10", "timestamp"])
+    if raw.empty:
+        return errors
+    rolled = load_state(cur)
+    raw = raw.sort_values(["node", "timestamp"], kind="stable").reset_index(drop=True)
+    # Gap from each sample to the node's next one (0 for the latest)
+    gaps = raw.groupby("node")["timestamp"].diff(-1).fillna(0).abs()
+    raw["area"] = raw["pm25"] * gaps
+    raw["gap"] = gaps
+
+    for name, width, table in ROLLUP_TIERS:
+        until = rolled.get(name)
+        if until is None:
+            continue
+        sub = raw[raw["timestamp"] < until].assign(bucket=lambda d: (d["timestamp"] // width) * width)
+        expected = sub.groupby(["node", "bucket"]).agg(
+            samples=("pm25", "size"),
+            pm25_sum=("pm25", "sum"),
+            pm25_min=("pm25", "min"),
+            pm25_max=("pm25", "max"),
+            pm10_sum=("pm10", "sum"),
+            pm10_max=("pm10", "max"),
+            pm25_area=("area", "sum"),
+            duration_ms=("gap", "sum"),
+        )
+        cur.execute(
+            f"SELECT node, bucket, samples, pm25_sum, pm25_min, pm25_max, pm10_sum, pm10_max, pm25_area, duration_ms FROM {table}"
+        )
+        got = pd.DataFrame(cur.fetchall(), columns=["node", "bucket"] + list(expected.columns))
+        got = got.set_index(["node", "bucket"]).sort_index()
+        expected = expected.sort_index()
+        if not got.index.equals(expected.index):
+            errors.append(f"{name}: bucket diversi ({len(got)} vs {len(expected)})")
+            continue
+        for col in expected.columns:
+            if not np.allclose(got[col].astype(float), expected[col].astype(float), rtol=1e-6, atol=1e-6):
+                errors.append(f"{name}: colonna {col} diversa")
+
+    rng = np.random.default_rng(seed)
+    t_lo, t_hi = int(raw["timestamp"].min()), int(raw["timestamp"].max()) + 1
+    nodes = list(raw["node"].unique())
+    for _ in range(windows):
+        a, b = sorted(int(x) for x in rng.integers(t_lo, t_hi, 2))
+        node = nodes[int(rng.integers(len(nodes)))]
+        stats = window_stats(cur, node, a, b, rolled)
+        sub = raw[(raw["node"] == node) & (raw["timestamp"] >= a) & (raw["timestamp"] < b)]
+        if stats["samples"] != len(sub):
+            errors.append(f"finestra {node} [{a}, {b}): samples {stats['samples']} vs {len(sub)}")
+            continue
+        if sub.empty:
+            continue
+        checks = {
+            "pm25_mean": sub["pm25"].mean(),
+            "pm25_std": sub["pm25"].std() if len(sub) > 1 else 0.0,
+            "pm10_max": sub["pm10"].max(),
+            "exposure": sub["area"].sum() / 3_600_000.0,
+            "exposure_hours": sub["gap"].sum() / 3_600_000.0,
+        }
+        for key, value in checks.items():
+            if not np.isclose(stats[key], value, rtol=1e-6, atol=1e-6):
+                errors.append(f"finestra {node} [{a}, {b}): {key} {stats[key]} vs {value}")
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=None, help="file SQLite (default: DATABASE_URL / SQLITE_PATH)")
+    parser.add_argument("--verify", action="store_true")
+    args = parser.parse_args()
+
+    if args.db:
+        db.DB_URL = None
+        db.SQLITE_PATH = args.db
+    with db.cursor() as cur:
+        ensure_rollup_schema(cur)
+        print("Rollup aggiornati:", refresh_rollups(cur))
+        if args.verify:
+            problems = verify(cur)
+            for p in problems:
+                print("ERRORE", p)
+            print("Verifica OK" if not problems else f"{len(problems)} differenze")
+            sys.exit(1 if problems else 0)
@@ -1,21 +1,100 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse, Response
+import logging
 import os
+import threading
+import time
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import joblib
-import psycopg2
+import db
+from anomaly import AnomalyDetector
+from features import (
+    FEATURE_VERSION,
+    LAGS,
+    WINDOW,
+    WINDOW_FEATURES,
+    bin_frame,
+    bundle_problems,
+    bundle_schema,
+    frame,
+    last_window,
+    last_windows,
+)
+from forecast import forecast_bounds, recursive_forecast
+from ingest import INGEST_MAX_ROWS, IngestWriter, PayloadTooLarge, parse_payload, validate_batch
+from profiling import PROFILE_DIR, PROFILE_TOKEN, ProfileMiddleware, authorized, profiled, tag as profile_tag
+from rollups import bucket_series, ensure_rollup_schema, load_state, refresh_rollups, tier_for_width, window_stats
+from shared_cache import (
+    IdPoller,
+    SharedSampleBuffer,
+    acquire_leader_lock,
+    bootstrap_buffer,
+    poll_buffer,
+    poll_rows,
+    publish_state,
+    read_state,
+)
+from sketches import LONGEST_HORIZON_MS, SketchStore
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-DB_URL = os.getenv("DATABASE_URL")
 MODEL_PATH = Path("./models/air_quality_model.joblib")
-LAGS = 6
+# Uncompressed copy of the bundle, memory-mapped so workers share its arrays
+MODEL_MMAP_PATH = MODEL_PATH.with_name("air_quality_model.mmap.joblib")
 HORIZON = [1, 2, 3]
 HORIZON_PRED = [1, 2, 3, 4, 5]
 WHO_THRESHOLD = 15.0
 NEURO_THRESHOLD = 25.0
 RECOVERY_HALFLIFE_H = 2.0
-
-app = FastAPI()
+SNAPSHOT_WINDOW = 360
+BUCKET_MS = 10 * 60 * 1000
+HISTORY_MAX_POINTS = 5000
+SKETCH_PATH = Path(os.getenv("SKETCH_PATH", "./models/sketches.npz"))
+SKETCH_HORIZON = os.getenv("SKETCH_HORIZON", "24h")
+SKETCH_MIN_SAMPLES = 30
+SKETCH_ALL_NODES = "*"
+ANOMALY_PATH = Path(os.getenv("ANOMALY_PATH", "./models/anomaly.npz"))
+# Hours replayed into the detector when it has no saved poll position
+ANOMALY_WARMUP_H = 6
+LATENCY_BUDGET_MS = float(os.getenv("LATENCY_BUDGET_MS", "1500"))
+STAGE_COST_DECAY = 0.9
+ROLLUP_INTERVAL_S = float(os.getenv("ROLLUP_INTERVAL_S", "60"))
+# Longest raw window loaded per request once rollups are available; every
+# section except data_quality only looks at the last 24 hours.
+RAW_WINDOW_H = 24
+# Multi-worker mode: per-node recent samples in shared memory, filled by the
+# worker that holds the leader lock and read by all of them.
+SHARED_CACHE_NAME = os.getenv("SHARED_CACHE_NAME")
+SHARED_CACHE_NODES = int(os.getenv("SHARED_CACHE_NODES", "256"))
+# Must hold RAW_WINDOW_H of a node's samples, or the default /ai/insights
+# window falls back to the DB: sized for ~10 s sampling plus 25% headroom
+# (256 nodes x 10800 samples x 24 B = 66 MB)
+SHARED_CACHE_SAMPLES = int(os.getenv("SHARED_CACHE_SAMPLES", str(RAW_WINDOW_H * 3600 // 10 * 5 // 4)))
+# Sketch and detector state is written to disk by the background thread
+STATE_SAVE_INTERVAL_S = float(os.getenv("STATE_SAVE_INTERVAL_S", "300"))
+SHARED_CACHE_MAX_AGE_MS = 10_000
+# New sensor_data rows (from /ingest or the Node backend) are read by id
+# this often and fed to the sketches, the detector and the shared buffer
+POLL_INTERVAL_S = float(os.getenv("POLL_INTERVAL_S", "1"))
+# The leader republishes sketch summaries at most this often
+SKETCH_PUBLISH_S = 10.0
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1024"))
+# Compact formats (Accept) for /predict and /ai/history: tables as
+# {column: [values]} instead of a list of objects
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+COLUMNAR_TYPE = "application/vnd.airquality.columnar+json"
+
+logger = logging.getLogger("serve")
+
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -23,34 +102,338 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_BYTES)
+if PROFILE_TOKEN:
+    app.add_middleware(ProfileMiddleware, tags=lambda: {"model": model_version()})
+
+sketch_store = SketchStore(SKETCH_PATH)
+anomaly_detector = AnomalyDetector(ANOMALY_PATH)
+
+
+ingest_writer = IngestWriter()
+# ready: the store holds the longest horizon (first fill done)
+sketch_state = {"ready": False, "backfill": None}
+rollup_state = {"ready": False}
+background_stop = threading.Event()
+shared = {"buffer": None, "leader": False, "state_mtime": None, "sketches": None}
+background = {"thread": None}
+
+
+def save_state() -> None:
+    # Only the worker that feeds the stores writes them back
+    if SHARED_CACHE_NAME and not shared["leader"]:
+        return
+    for store in (sketch_store, anomaly_detector):
+        try:
+            store.save()
+        except Exception:
+            logger.exception("Errore salvataggio %s", store.path)
+
+
+def poll_batches(rows: list):
+    # (id, node, timestamp, pm25, pm10) rows -> per node arrays
+    if not rows:
+        return
+    batch = pd.DataFrame(rows, columns=["id", "node", "timestamp", "pm25", "pm10"])
+    ts_ms = batch["timestamp"].to_numpy(dtype=np.int64)
+    pm25 = batch["pm25"].to_numpy(dtype=float)
+    pm10 = batch["pm10"].to_numpy(dtype=float)
+    for node, idx in batch.groupby("node").indices.items():
+        yield node, ts_ms[idx], pm25[idx], pm10[idx]
+
+
+def feed_sketches(rows: list) -> None:
+    # Every row is counted once (rows come by id), late ones included
+    if not rows:
+        return
+    values = np.asarray([r[2:] for r in rows], dtype=float)
+    sketch_store.update(SKETCH_ALL_NODES, values[:, 0].astype(np.int64), values[:, 1], values[:, 2])
+    for node, ts_ms, pm25, pm10 in poll_batches(rows):
+        sketch_store.update(node, ts_ms, pm25, pm10)
+
+
+def backfill_sketches(until_id: int) -> None:
+    # First fill: the longest horizon of rows the poll starts after, on its
+    # own thread so polling goes on meanwhile
+    try:
+        since_ms = int(time.time() * 1000) - LONGEST_HORIZON_MS
+        # Server-side cursor: up to 30 days of every node
+        with db.cursor(name="sketch_backfill") as cur:
+            cur.execute(
+                db.sql("SELECT id, node, timestamp, pm25, pm10 FROM sensor_data WHERE timestamp > %s AND id <= %s"),
+                (since_ms, until_id),
+            )
+            while True:
+                if background_stop.is_set():
+                    return
+                rows = cur.fetchmany(50_000)
+                if not rows:
+                    break
+                feed_sketches(rows)
+        sketch_state["ready"] = True
+        logger.info("Backfill sketch completato")
+    except Exception:
+        logger.exception("Errore backfill sketch")
+
+
+def start_sketch_feed(cur) -> IdPoller:
+    sketch_state["ready"] = False
+    if sketch_store.position is not None:
+        sketch_state["ready"] = True
+        return IdPoller(*sketch_store.position)
+    # Without a position the stored counts cannot be matched to rows:
+    # rebuild them
+    sketch_store.clear()
+    poller = IdPoller.at_head(cur)
+    sketch_state["backfill"] = threading.Thread(
+        target=backfill_sketches, args=(poller.last_id,), name="sketch-backfill", daemon=True
+    )
+    sketch_state["backfill"].start()
+    return poller
+
+
+def feed_anomalies(rows: list) -> None:
+    for node, ts_ms, pm25, pm10 in poll_batches(rows):
+        anomaly_detector.update(node, ts_ms, pm25, pm10)
+
+
+def start_anomaly_feed(cur) -> IdPoller:
+    # Resume after the rows the saved state was built from, or warm the
+    # detector up on the last hours
+    if anomaly_detector.position is not None:
+        return IdPoller(*anomaly_detector.position)
+    poller = IdPoller.at_head(cur)
+    since_ms = int(time.time() * 1000) - ANOMALY_WARMUP_H * 3600 * 1000
+    cur.execute(
+        db.sql(
+            "SELECT id, node, timestamp, pm25, pm10 FROM sensor_data "
+            "WHERE timestamp >= %s AND id <= %s ORDER BY timestamp ASC"
+        ),
+        (since_ms, poller.last_id),
+    )
+    feed_anomalies(cur.fetchall())
+    anomaly_detector.position = poller.position()
+    return poller
+
+
+def background_worker() -> None:
+    # One process per deployment polls new rows into the sketches and the
+    # detector (and the shared buffer), refreshes rollups and saves their
+    # state: the only one when running single-process, otherwise the worker
+    # holding the leader lock (others keep trying to take over, and read
+    # what it publishes).
+    lock = None
+    buffer = None
+    poller = None
+    detector = None
+    sketches = None
+    summaries = None
+    next_publish = 0.0
+    next_rollup = 0.0
+    next_save = time.monotonic() + STATE_SAVE_INTERVAL_S
+    while True:
+        if SHARED_CACHE_NAME and lock is None:
+            lock = acquire_leader_lock(SHARED_CACHE_NAME)
+            if lock is not None:
+                buffer = SharedSampleBuffer.create(SHARED_CACHE_NAME, SHARED_CACHE_NODES, SHARED_CACHE_SAMPLES)
+                shared["buffer"] = buffer
+                # Resume from what the previous leader saved
+                sketch_store.load()
+                anomaly_detector.load()
+                shared["leader"] = True
+        leader = lock is not None or not SHARED_CACHE_NAME
+        if leader:
+            try:
+                with db.cursor() as cur:
+                    backfill = sketch_state["backfill"]
+                    if not sketch_state["ready"] and backfill is not None and not backfill.is_alive():
+                        sketches = None  # failed, start over
+                    if detector is None:
+                        detector = start_anomaly_feed(cur)
+                    if sketches is None:
+                        sketches = start_sketch_feed(cur)
+                    since_ms = int(time.time() * 1000) - RAW_WINDOW_H * 3600 * 1000
+                    if buffer is not None and poller is None:
+                        poller = bootstrap_buffer(buffer, cur, since_ms)
+                    floor = min(detector.floor(), sketches.floor())
+                    rows = poll_rows(cur, [detector, sketches])
+                    fed = detector.take(rows)
+                    if fed:
+                        feed_anomalies(fed)
+                        anomaly_detector.position = detector.position()
+                    counted = sketches.take(rows)
+                    feed_sketches(counted)
+                    if sketch_state["ready"]:
+                        # Before that a saved state would lack backfill rows
+                        sketch_store.position = sketches.position()
+                    if buffer is not None:
+                        # Usually the same rows: re-read only if it lags behind
+                        if poller.floor() < floor:
+                            rows = poll_rows(cur, [poller])
+                        poll_buffer(buffer, poller, rows, since_ms)
+                    if sketch_state["ready"] and summaries is None:
+                        next_publish = 0.0  # first fill just completed
+                    if SHARED_CACHE_NAME and (fed or counted or time.monotonic() >= next_publish):
+                        if time.monotonic() >= next_publish:
+                            summaries = sketch_store.summaries(SKETCH_HORIZON) if sketch_state["ready"] else None
+                            next_publish = time.monotonic() + SKETCH_PUBLISH_S
+                        publish_state(
+                            SHARED_CACHE_NAME, {"anomalies": anomaly_detector.export(), "sketches": summaries}
+                        )
+                    if rollup_state["ready"] and ROLLUP_INTERVAL_S > 0 and time.monotonic() >= next_rollup:
+                        refresh_rollups(cur)
+                        next_rollup = time.monotonic() + ROLLUP_INTERVAL_S
+            except Exception:
+                logger.exception("Errore aggiornamento rollup/sketch/anomalie/cache condivisa")
+            if time.monotonic() >= next_save:
+                save_state()
+                next_save = time.monotonic() + STATE_SAVE_INTERVAL_S
+        if background_stop.wait(POLL_INTERVAL_S if leader else 5.0):
+            return
+
+
+def shared_buffer() -> SharedSampleBuffer | None:
+    buffer = shared["buffer"]
+    if buffer is not None and not buffer.retired:
+        return buffer
+    try:
+        buffer = SharedSampleBuffer.attach(SHARED_CACHE_NAME)
+    except FileNotFoundError:
+        buffer = None
+    shared["buffer"] = buffer
+    return buffer
+
+
+@app.on_event("startup")
+def startup():
+    if not SHARED_CACHE_NAME:
+        # With several workers only the leader loads them (see
+        # background_worker), the others read what it publishes
+        sketch_store.load()
+        anomaly_detector.load()
+    try:
+        load_model_bundle()
+    except Exception:
+        logger.exception("Caricamento modello fallito, riprovo alla prima richiesta")
+    if not db.configured():
+        # Nothing to poll: the saved sketches are all there is
+        sketch_state["ready"] = True
+        return
+    ingest_writer.start()
+    background_stop.clear()
+    try:
+        with db.cursor() as cur:
+            ensure_rollup_schema(cur)
+        rollup_state["ready"] = True
+    except Exception:
+        logger.exception("Tabelle rollup non disponibili, uso solo dati raw")
+    background["thread"] = threading.Thread(target=background_worker, name="background-refresh", daemon=True)
+    background["thread"].start()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    background_stop.set()
+    ingest_writer.stop()
+    if background["thread"] is not None:
+        # Let a save in progress finish before the final one
+        background["thread"].join(timeout=10.0)
+        background["thread"] = None
+    save_state()
 
 
 def clamp(value: float, lo: float, hi: float) -> float:
     return max(lo, min(hi, value))
 
 
+# Degraded mode: observed cost of each stage (EWMA, per window size class)
+# decides whether the full version still fits in the remaining budget.
+stage_costs_ms: dict[tuple[str, int], float] = {}
+degraded_counts: dict[str, int] = {}
+request_counts: dict[str, int] = {}
+metrics_lock = threading.Lock()
+# Time spent in one-off work (model reload) by the current thread's stage;
+# kept out of the estimate so a cold start does not degrade later requests
+stage_context = threading.local()
+
+
+def new_deadline(budget_ms: float | None) -> float | None:
+    budget = LATENCY_BUDGET_MS if budget_ms is None else budget_ms
+    if budget <= 0:
+        return None
+    return time.monotonic() + budget / 1000.0
+
+
+def count_request(endpoint: str) -> None:
+    with metrics_lock:
+        request_counts[endpoint] = request_counts.get(endpoint, 0) + 1
+
+
+def run_stage(name: str, rows: int, deadline: float | None, full, fallback, degraded: list[str]):
+    key = (name, rows.bit_length() // 2)
+    expected = stage_costs_ms.get(key)
+    if deadline is not None and expected is not None:
+        remaining_ms = (deadline - time.monotonic()) * 1000.0
+        if remaining_ms < expected:
+            degraded.append(name)
+            with metrics_lock:
+                degraded_counts[name] = degraded_counts.get(name, 0) + 1
+                # Let the estimate decay so the full path is retried later
+                stage_costs_ms[key] = expected * STAGE_COST_DECAY
+            return fallback()
+    stage_context.one_off_ms = 0.0
+    started = time.monotonic()
+    result = full()
+    elapsed_ms = (time.monotonic() - started) * 1000.0 - stage_context.one_off_ms
+    with metrics_lock:
+        prev = stage_costs_ms.get(key)
+        stage_costs_ms[key] = elapsed_ms if prev is None else 0.8 * prev + 0.2 * elapsed_ms
+    return result
+
+
+def load_shared_recent(hours: int, node: str) -> pd.DataFrame | None:
+    buffer = shared_buffer()
+    if buffer is None or not buffer.is_fresh(SHARED_CACHE_MAX_AGE_MS):
+        return None
+    found = buffer.read(node)
+    if found is None:
+        return None
+    covered_from, rows = found
+    cutoff_ms = int(pd.Timestamp.utcnow().timestamp() * 1000) - hours * 3600 * 1000
+    if covered_from > cutoff_ms:
+        return None
+    rows = rows[rows[:, 0] >= cutoff_ms]
+    return pd.DataFrame(
+        {
+            "pm25": rows[:, 1],
+            "pm10": rows[:, 2],
+            "timestamp": pd.to_datetime(rows[:, 0].astype(np.int64), unit="ms", utc=True),
+        }
+    )
+
+
 def load_recent_data(hours: int = 6, node: str | None = None) -> pd.DataFrame:
-    if not DB_URL:
+    if not db.configured():
         return pd.DataFrame(columns=["pm25", "pm10", "timestamp"])
-    conn = psycopg2.connect(DB_URL, sslmode="require")
-    try:
-        with conn.cursor() as cur:
-            cutoff_ms = (
-                int(pd.Timestamp.utcnow().timestamp() * 1000) - hours * 3600 * 1000
+    if SHARED_CACHE_NAME and node:
+        df = load_shared_recent(hours, node)
+        if df is not None:
+            return df
+    with db.cursor() as cur:
+        cutoff_ms = (
+            int(pd.Timestamp.utcnow().timestamp() * 1000) - hours * 3600 * 1000
+        )
+        if node:
+            cur.execute(
+                db.sql("SELECT pm25, pm10, timestamp FROM sensor_data WHERE node = %s AND timestamp >= %s ORDER BY timestamp ASC"),
+                (node, cutoff_ms),
             )
-            if node:
-                cur.execute(
-                    "SELECT pm25, pm10, timestamp FROM sensor_data WHERE node = %s AND timestamp >= %s ORDER BY timestamp ASC",
-                    (node, cutoff_ms),
-                )
-            else:
-                cur.execute(
-                    "SELECT pm25, pm10, timestamp FROM sensor_data WHERE timestamp >= %s ORDER BY timestamp ASC",
-                    (cutoff_ms,),
-                )
-            rows = cur.fetchall()
-    finally:
-        conn.close()
+        else:
+            cur.execute(
+                db.sql("SELECT pm25, pm10, timestamp FROM sensor_data WHERE timestamp >= %s ORDER BY timestamp ASC"),
+                (cutoff_ms,),
+            )
+        rows = cur.fetchall()
 
     if not rows:
         return pd.DataFrame(columns=["pm25", "pm10", "timestamp"])
@@ -60,36 +443,166 @@ def load_recent_data(hours: int = 6, node: str | None = None) -> pd.DataFrame:
     return df
 
 
-def to_features(df: pd.DataFrame, lags: int = 6) -> pd.DataFrame:
-    if df.empty or "timestamp" not in df.columns:
-        return pd.DataFrame()
-    d = df.copy()
-    d["bucket"] = d["timestamp"].dt.floor("10min")
-    hourly = (
-        d.groupby("bucket", as_index=False)[["pm25", "pm10"]]
+def sync_published() -> None:
+    # Workers other than the leader only read state: pick up what it last
+    # published (see background_worker)
+    if not SHARED_CACHE_NAME or shared["leader"]:
+        return
+    found = read_state(SHARED_CACHE_NAME, shared["state_mtime"])
+    if found is not None:
+        shared["state_mtime"], state = found
+        anomaly_detector.restore(state["anomalies"])
+        shared["sketches"] = state["sketches"]
+
+
+def anomaly_status(node: str | None, since_ms: int | None = None) -> dict | None:
+    if not node:
+        return None
+    sync_published()
+    return anomaly_detector.status(node, since_ms)
+
+
+def sketch_baseline(node: str | None) -> dict | None:
+    # None (raw-window thresholds) until the first fill has completed
+    key = node or SKETCH_ALL_NODES
+    if SHARED_CACHE_NAME and not shared["leader"]:
+        sync_published()
+        baseline = (shared["sketches"] or {}).get(key)
+    elif sketch_state["ready"]:
+        baseline = sketch_store.summary(key, SKETCH_HORIZON)
+    else:
+        return None
+    if not baseline or baseline["pm25"]["count"] < SKETCH_MIN_SAMPLES:
+        return None
+    return baseline
+
+
+def load_snapshot_data(hours: int = 24, window: int = 360) -> pd.DataFrame:
+    columns = ["node", "pm25", "pm10", "lat", "lon", "timestamp"]
+    if not db.configured():
+        return pd.DataFrame(columns=columns)
+    with db.cursor() as cur:
+        cutoff_ms = (
+            int(pd.Timestamp.utcnow().timestamp() * 1000) - hours * 3600 * 1000
+        )
+        # Latest `window` rows per node in one pass (ranked inside the DB)
+        cur.execute(
+            db.sql(
+                """
+                SELECT node, pm25, pm10, lat, lon, timestamp FROM (
+                    SELECT node, pm25, pm10, lat, lon, timestamp,
+                           ROW_NUMBER() OVER (PARTITION BY node ORDER BY timestamp DESC) AS rn
+                    FROM sensor_data WHERE timestamp >= %s
+                ) ranked
+                WHERE rn <= %s
+                ORDER BY node ASC, timestamp ASC
+                """
+            ),
+            (cutoff_ms, window),
+        )
+        rows = cur.fetchall()
+
+    if not rows:
+        return pd.DataFrame(columns=columns)
+
+    df = pd.DataFrame(rows, columns=columns)
+    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ms", utc=True)
+    return df
+
+
+def load_snapshot_aggregates(hours: int = 24) -> tuple[pd.DataFrame, pd.DataFrame]:
+    # Time-windowed parts of the snapshot, aggregated inside the DB so they do
+    # not depend on how many rows a node sends: moving averages anchored at
+    # each node's latest sample, and its latest WINDOW 10-minute bucket means.
+    ma_columns = ["node", "ma_5m", "ma_15m", "ma_60m"]
+    bucket_columns = ["node", "bucket", "pm25", "pm10"]
+    if not db.configured():
+        return pd.DataFrame(columns=ma_columns), pd.DataFrame(columns=bucket_columns)
+    cutoff_ms = int(pd.Timestamp.utcnow().timestamp() * 1000) - hours * 3600 * 1000
+    with db.cursor() as cur:
+        cur.execute(
+            db.sql(
+                """
+                SELECT s.node,
+                       AVG(CASE WHEN s.timestamp >= l.last_ts - %s THEN s.pm25 END),
+                       AVG(CASE WHEN s.timestamp >= l.last_ts - %s THEN s.pm25 END),
+                       AVG(s.pm25)
+                FROM sensor_data s
+                JOIN (SELECT node, MAX(timestamp) AS last_ts FROM sensor_data WHERE timestamp >= %s GROUP BY node) l
+                  ON s.node = l.node
+                WHERE s.timestamp >= l.last_ts - %s AND s.timestamp >= %s
+                GROUP BY s.node
+                """
+            ),
+            (5 * 60_000, 15 * 60_000, cutoff_ms, 60 * 60_000, cutoff_ms),
+        )
+        ma = pd.DataFrame(cur.fetchall(), columns=ma_columns)
+        cur.execute(
+            db.sql(
+                """
+                SELECT node, bucket, pm25, pm10 FROM (
+                    SELECT node, bucket, AVG(pm25) AS pm25, AVG(pm10) AS pm10,
+                           ROW_NUMBER() OVER (PARTITION BY node ORDER BY bucket DESC) AS rn
+                    FROM (SELECT node, (timestamp / %s) * %s AS bucket, pm25, pm10 FROM sensor_data WHERE timestamp >= %s) s
+                    GROUP BY node, bucket
+                ) b
+                WHERE rn <= %s
+                ORDER BY node ASC, bucket ASC
+                """
+            ),
+            (BUCKET_MS, BUCKET_MS, cutoff_ms, WINDOW),
+        )
+        buckets = pd.DataFrame(cur.fetchall(), columns=bucket_columns)
+    ma[ma_columns[1:]] = ma[ma_columns[1:]].astype(float)
+    buckets["bucket"] = buckets["bucket"].astype("int64")
+    buckets[["pm25", "pm10"]] = buckets[["pm25", "pm10"]].astype(float)
+    return ma.set_index("node"), buckets
+
+
+def load_history_data(
+    from_ms: int, to_ms: int, node: str | None = None, bucket_ms: int | None = None
+) -> pd.DataFrame:
+    columns = ["timestamp", "pm25", "pm10"]
+    if not db.configured():
+        return pd.DataFrame(columns=columns)
+    where = "timestamp >= %s AND timestamp <= %s"
+    params: list = [from_ms, to_ms]
+    if node:
+        where += " AND node = %s"
+        params.append(node)
+    if bucket_ms:
+        # Same 10-minute floor as features.bin_samples, aggregated inside the DB
+        query = (
+            "SELECT (timestamp / %s) * %s AS bucket, AVG(pm25), AVG(pm10) "
+            f"FROM sensor_data WHERE {where} GROUP BY bucket ORDER BY bucket ASC"
+        )
+        params = [bucket_ms, bucket_ms] + params
+    else:
+        query = f"SELECT timestamp, pm25, pm10 FROM sensor_data WHERE {where} ORDER BY timestamp ASC"
+    with db.cursor() as cur:
+        cur.execute(db.sql(query), params)
+        rows = cur.fetchall()
+
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    df = pd.DataFrame(rows, columns=columns)
+    df["timestamp"] = df["timestamp"].astype("int64")
+    df[["pm25", "pm10"]] = df[["pm25", "pm10"]].astype(float)
+    return df
+
+
+def bucket_means(df: pd.DataFrame) -> pd.DataFrame:
+    # 10-minute means keyed by bucket start, shaped like the raw frame
+    if df.empty:
+        return df
+    return (
+        df.assign(timestamp=df["timestamp"].dt.floor("10min"))
+        .groupby("timestamp", as_index=False)[["pm25", "pm10"]]
         .mean()
-        .sort_values("bucket")
     )
-    for i in range(1, lags + 1):
-        hourly[f"pm25_lag_{i}"] = hourly["pm25"].shift(i)
-        hourly[f"pm10_lag_{i}"] = hourly["pm10"].shift(i)
-
-    hourly["pm25_roll_3"] = hourly["pm25"].shift(1).rolling(3).mean()
-    hourly["pm25_roll_6"] = hourly["pm25"].shift(1).rolling(6).mean()
-    hourly["pm25_std_6"] = hourly["pm25"].shift(1).rolling(6).std()
-    hourly["pm10_roll_3"] = hourly["pm10"].shift(1).rolling(3).mean()
-    hourly["pm10_roll_6"] = hourly["pm10"].shift(1).rolling(6).mean()
-    hourly["pm10_std_6"] = hourly["pm10"].shift(1).rolling(6).std()
-    hourly["pm25_diff_1"] = hourly["pm25"].diff()
-    hourly["pm10_diff_1"] = hourly["pm10"].diff()
-
-    hourly["hour_of_day"] = hourly["bucket"].dt.hour
-    hourly["day_of_week"] = hourly["bucket"].dt.dayofweek
-    hourly = hourly.dropna().reset_index(drop=True)
-    return hourly
-
-
-def simple_forecast(df: pd.DataFrame, horizon: list[int]) -> dict:
+
+
+def simple_forecast(df: pd.DataFrame, horizon: list[int], baseline: dict | None = None) -> dict:
     if df.empty:
         return {h: None for h in horizon}
     recent = df.sort_values("timestamp").tail(30)
@@ -106,62 +619,89 @@ def simple_forecast(df: pd.DataFrame, horizon: list[int]) -> dict:
     preds = {}
     for h in horizon:
         preds[h] = round(clamp(base + slope_per_hour * h, 5, 300), 1)
-    return postprocess_forecast(preds, df)
+    return postprocess_forecast(preds, df, baseline)
+
+
+model_cache = {"mtime": None, "bundle": None}
+model_lock = threading.Lock()
 
 
 def load_model_bundle() -> dict | None:
     if not MODEL_PATH.exists():
         return None
-    return joblib.load(MODEL_PATH)
+    mtime = MODEL_PATH.stat().st_mtime
+    if model_cache["mtime"] == mtime:
+        return model_cache["bundle"]
+    started = time.monotonic()
+    with model_lock:
+        if model_cache["mtime"] != mtime:
+            bundle = None
+            if SHARED_CACHE_NAME:
+                # Workers share the pages of an uncompressed copy loaded in mmap
+                try:
+                    if not MODEL_MMAP_PATH.exists() or MODEL_MMAP_PATH.stat().st_mtime < mtime:
+                        tmp = MODEL_MMAP_PATH.with_name(f"{MODEL_MMAP_PATH.name}.{os.getpid()}.tmp")
+                        joblib.dump(joblib.load(MODEL_PATH), tmp, compress=0)
+                        os.replace(tmp, MODEL_MMAP_PATH)
+                    bundle = joblib.load(MODEL_MMAP_PATH, mmap_mode="r")
+                except OSError:
+                    logger.exception("Copia mmap del modello non disponibile, caricamento normale")
+            if bundle is None:
+                bundle = joblib.load(MODEL_PATH)
+            problems = bundle_problems(bundle)
+            if problems:
+                # Features computed here would not match what the models were
+                # trained on: serve as if there were no model (rule-based paths)
+                logger.error("Modello %s non compatibile: %s", MODEL_PATH, "; ".join(problems))
+                bundle = None
+            model_cache["problems"] = problems
+            model_cache["bundle"] = bundle
+            model_cache["mtime"] = mtime
+    # Includes waiting for another thread's load
+    stage_context.one_off_ms = getattr(stage_context, "one_off_ms", 0.0) + (time.monotonic() - started) * 1000.0
+    return model_cache["bundle"]
+
+
+def model_version() -> str | None:
+    bundle = model_cache["bundle"]
+    return bundle.get("trained_at") if bundle else None
+
+
+def model_info() -> dict:
+    bundle = model_cache["bundle"]
+    schema = bundle_schema(bundle) if bundle else {}
+    return {
+        "trained_at": model_version(),
+        "feature_version": schema.get("version"),
+        "serve_feature_version": FEATURE_VERSION,
+        "problems": model_cache.get("problems", []),
+    }
 
 
-def model_forecast(df: pd.DataFrame) -> dict:
+def model_forecast(df: pd.DataFrame, baseline: dict | None = None) -> dict:
     if not MODEL_PATH.exists():
-        return simple_forecast(df, HORIZON)
-    hourly = to_features(df, LAGS)
-    if hourly.empty:
-        return simple_forecast(df, HORIZON)
-    if len(hourly) < LAGS:
-        return simple_forecast(df, HORIZON)
+        return simple_forecast(df, HORIZON, baseline)
+    bucket_ms, pm25, pm10 = bin_frame(df)
+    # At least LAGS complete feature rows
+    if len(bucket_ms) < 2 * LAGS:
+        return simple_forecast(df, HORIZON, baseline)
     bundle = load_model_bundle()
     if not bundle:
-        return simple_forecast(df, HORIZON)
+        return simple_forecast(df, HORIZON, baseline)
     if bundle.get("r2_pm25") is not None and bundle.get("r2_pm25", 0) < 0:
-        return simple_forecast(df, HORIZON)
+        return simple_forecast(df, HORIZON, baseline)
     model = bundle["model_pm25"]
 
-    preds = {}
-    base_series = df.copy()
-    base_series = base_series.sort_values("timestamp")
-
-    for h in [1, 2, 3, 4, 5]:
-        features = to_features(base_series, LAGS)
-        if features.empty:
-            return simple_forecast(df, HORIZON)
-        X = features.drop(columns=["bucket", "pm25", "pm10"])
-        row = X.iloc[[-1]]
-        p = float(model.predict(row)[0])
-        preds[h] = round(clamp(p, 5, 300), 1)
-
-        next_hour = features.iloc[-1]["bucket"] + pd.Timedelta(hours=1)
-        base_series = pd.concat(
-            [
-                base_series,
-                pd.DataFrame(
-                    [{"timestamp": next_hour.to_pydatetime(), "pm25": p, "pm10": float(features.iloc[-1]["pm10"])}]
-                ),
-            ],
-            ignore_index=True,
-        )
-
-    return postprocess_forecast(preds, df)
+    values = recursive_forecast(model, pm25[-(LAGS + 1) :], pm10[-(LAGS + 1) :], bucket_ms[-1:], len(HORIZON_PRED))[0]
+    preds = {h: round(clamp(float(p), 5, 300), 1) for h, p in zip(HORIZON_PRED, values)}
+    return postprocess_forecast(preds, df, baseline)
 
 
 def model_forecast_pm10(df: pd.DataFrame) -> dict:
     if not MODEL_PATH.exists():
         return {}
-    hourly = to_features(df, LAGS)
-    if hourly.empty:
+    bucket_ms, pm25, pm10 = bin_frame(df)
+    if len(bucket_ms) <= LAGS:
         return {}
     bundle = load_model_bundle()
     if not bundle:
@@ -172,43 +712,26 @@ def model_forecast_pm10(df: pd.DataFrame) -> dict:
     if model is None:
         return {}
 
-    preds = {}
-    base_series = df.copy()
-    base_series = base_series.sort_values("timestamp")
-    for h in [1, 2, 3, 4, 5]:
-        features = to_features(base_series, LAGS)
-        if features.empty:
-            return {}
-        X = features.drop(columns=["bucket", "pm25", "pm10"])
-        row = X.iloc[[-1]]
-        p = float(model.predict(row)[0])
-        preds[h] = round(clamp(p, 5, 500), 1)
-
-        next_hour = features.iloc[-1]["bucket"] + pd.Timedelta(hours=1)
-        base_series = pd.concat(
-            [
-                base_series,
-                pd.DataFrame(
-                    [{"timestamp": next_hour.to_pydatetime(), "pm25": float(features.iloc[-1]["pm25"]), "pm10": p}]
-                ),
-            ],
-            ignore_index=True,
-        )
-
-    return preds
+    values = recursive_forecast(
+        model, pm25[-(LAGS + 1) :], pm10[-(LAGS + 1) :], bucket_ms[-1:], len(HORIZON_PRED), target="pm10"
+    )[0]
+    return {h: round(clamp(float(p), 5, 500), 1) for h, p in zip(HORIZON_PRED, values)}
 
 
-def postprocess_forecast(preds: dict, df: pd.DataFrame) -> dict:
+def postprocess_forecast(preds: dict, df: pd.DataFrame, baseline: dict | None = None) -> dict:
     if df.empty:
         return preds
     recent = df.sort_values("timestamp").tail(180)
     if recent.empty:
         return preds
     base = float(recent["pm25"].iloc[-1])
-    q10 = float(recent["pm25"].quantile(0.1))
-    q90 = float(recent["pm25"].quantile(0.9))
-    lo = max(5.0, q10, base * 0.7)
-    hi = max(80.0, q90 * 1.3, base * 1.5)
+    if baseline:
+        q10 = baseline["pm25"]["q10"]
+        q90 = baseline["pm25"]["q90"]
+    else:
+        q10 = float(recent["pm25"].quantile(0.1))
+        q90 = float(recent["pm25"].quantile(0.9))
+    lo, hi = (float(v) for v in forecast_bounds(base, q10, q90))
     cleaned = {}
     for h, v in preds.items():
         if v is None:
@@ -268,6 +791,23 @@ def exposure_metrics(df: pd.DataFrame) -> dict:
     }
 
 
+def exposure_windowed(node: str | None, df: pd.DataFrame) -> dict:
+    # Same integrals as exposure_metrics, summed from rollup tiers plus raw
+    # edges; only defined per node, like the rollups themselves.
+    if not node or not rollup_state["ready"] or len(df) < 2:
+        return exposure_metrics(df)
+    ts_ms = df["timestamp"].astype("int64") // 1_000_000
+    first, now = int(ts_ms.min()), int(ts_ms.max())
+    out = {}
+    with db.cursor() as cur:
+        rolled = load_state(cur)
+        for h in (1, 6, 24):
+            stats = window_stats(cur, node, max(now - h * 3600 * 1000, first), now, rolled)
+            out[f"exposure_{h}h"] = stats["exposure"]
+            out[f"avg_{h}h"] = stats["exposure_avg"]
+    return {k: out[k] for k in ("exposure_1h", "exposure_6h", "exposure_24h", "avg_1h", "avg_6h", "avg_24h")}
+
+
 def recovery_metrics(df: pd.DataFrame) -> dict:
     if df.empty:
         return {
@@ -350,7 +890,14 @@ def moving_averages(df: pd.DataFrame) -> dict:
     }
 
 
-def adaptive_threshold(df: pd.DataFrame) -> dict:
+def adaptive_threshold(df: pd.DataFrame, baseline: dict | None = None) -> dict:
+    if baseline:
+        pm25 = baseline["pm25"]
+        adaptive = max(WHO_THRESHOLD, pm25["mean"] + pm25["std"])
+        return {
+            "adaptive_threshold": round(max(adaptive, pm25["q90"] * 0.9), 1),
+            "method": f"sketch {baseline['horizon']} mean+std / q90",
+        }
     if df.empty:
         return {"adaptive_threshold": WHO_THRESHOLD, "method": "fallback"}
     recent = df.tail(360)
@@ -384,6 +931,24 @@ def data_quality(df: pd.DataFrame) -> dict:
     }
 
 
+def data_quality_window(node: str | None, hours: int, df: pd.DataFrame) -> dict:
+    # data_quality over a window longer than the raw rows that were loaded
+    now_ms = int(pd.Timestamp.utcnow().timestamp() * 1000)
+    with db.cursor() as cur:
+        stats = window_stats(cur, node, now_ms - hours * 3600 * 1000, now_ms + 1)
+    samples = stats["samples"]
+    recent = data_quality(df)
+    if samples < 2:
+        return {"samples": samples, "last_gap_s": None, "sample_rate_min": 0}
+    duration_min = (stats["ts_max"] - stats["ts_min"]) / 60000.0
+    sample_rate = (samples - 1) / duration_min if duration_min > 0 else 0
+    return {
+        "samples": samples,
+        "last_gap_s": recent["last_gap_s"],
+        "sample_rate_min": round(sample_rate, 2),
+    }
+
+
 def realtime_metrics(df: pd.DataFrame) -> dict:
     if df.empty:
         return {"pm25": 0, "pm10": 0, "ratio": 0, "trend": 0, "volatility": 0}
@@ -447,49 +1012,11 @@ def source_classifier_ml(df: pd.DataFrame) -> dict:
     if df.empty:
         return {"label": "unknown", "confidence": 0.0}
 
-    recent = df.sort_values("timestamp").tail(6)
-    if len(recent) < 2:
-        return source_classifier(df)
-    recent["bucket"] = recent["timestamp"].dt.floor("10min")
-    recent = recent.groupby("bucket", as_index=False)[["pm25", "pm10"]].mean().sort_values("bucket")
-    if len(recent) < 2:
+    X = last_window(*bin_frame(df))
+    if X is None:
         return source_classifier(df)
-
-    t0 = recent["bucket"].iloc[0]
-    t1 = recent["bucket"].iloc[-1]
-    duration_min = max((t1 - t0).total_seconds() / 60.0, 1)
-    pm25_last = float(recent["pm25"].iloc[-1])
-    pm10_last = float(recent["pm10"].iloc[-1])
-    ratio = pm25_last / pm10_last if pm10_last > 0 else 0
-    delta = pm25_last - float(recent["pm25"].iloc[0])
-    trend = (delta / duration_min) * 60.0
-    volatility = float(recent["pm25"].std()) if len(recent) > 1 else 0.0
-    avg_pm25 = float(recent["pm25"].mean())
-    avg_pm10 = float(recent["pm10"].mean())
-    max_pm25 = float(recent["pm25"].max())
-    min_pm25 = float(recent["pm25"].min())
-    spike = max_pm25 - avg_pm25
-
-    X = pd.DataFrame(
-        [
-            {
-                "pm25_last": pm25_last,
-                "pm10_last": pm10_last,
-                "ratio": ratio,
-                "delta": delta,
-                "trend": trend,
-                "volatility": volatility,
-                "avg_pm25": avg_pm25,
-                "avg_pm10": avg_pm10,
-                "max_pm25": max_pm25,
-                "min_pm25": min_pm25,
-                "spike": spike,
-                "duration_min": duration_min,
-            }
-        ]
-    )
     model = bundle["model_source"]
-    proba = model.predict_proba(X)[0]
+    proba = model.predict_proba(frame(X, WINDOW_FEATURES, model))[0]
     classes = bundle.get("source_classes", model.classes_)
     best_idx = int(proba.argmax())
     label = classes[best_idx]
@@ -504,57 +1031,104 @@ def vulnerability_ml(df: pd.DataFrame) -> dict:
     if not bundle or not bundle.get("model_vulnerability") or df.empty:
         return {"score": 0.0, "level": "low"}
 
-    recent = df.sort_values("timestamp").tail(6)
-    if len(recent) < 2:
+    X = last_window(*bin_frame(df))
+    if X is None:
         return {"score": 0.0, "level": "low"}
-    recent["bucket"] = recent["timestamp"].dt.floor("10min")
-    recent = recent.groupby("bucket", as_index=False)[["pm25", "pm10"]].mean().sort_values("bucket")
-    if len(recent) < 2:
-        return {"score": 0.0, "level": "low"}
-
-    t0 = recent["bucket"].iloc[0]
-    t1 = recent["bucket"].iloc[-1]
-    duration_min = max((t1 - t0).total_seconds() / 60.0, 1)
-    pm25_last = float(recent["pm25"].iloc[-1])
-    pm10_last = float(recent["pm10"].iloc[-1])
-    ratio = pm25_last / pm10_last if pm10_last > 0 else 0
-    delta = pm25_last - float(recent["pm25"].iloc[0])
-    trend = (delta / duration_min) * 60.0
-    volatility = float(recent["pm25"].std()) if len(recent) > 1 else 0.0
-    avg_pm25 = float(recent["pm25"].mean())
-    avg_pm10 = float(recent["pm10"].mean())
-    max_pm25 = float(recent["pm25"].max())
-    min_pm25 = float(recent["pm25"].min())
-    spike = max_pm25 - avg_pm25
-
-    X = pd.DataFrame(
-        [
-            {
-                "pm25_last": pm25_last,
-                "pm10_last": pm10_last,
-                "ratio": ratio,
-                "delta": delta,
-                "trend": trend,
-                "volatility": volatility,
-                "avg_pm25": avg_pm25,
-                "avg_pm10": avg_pm10,
-                "max_pm25": max_pm25,
-                "min_pm25": min_pm25,
-                "spike": spike,
-                "duration_min": duration_min,
-            }
-        ]
-    )
     model = bundle["model_vulnerability"]
-    score = float(model.predict(X)[0])
+    score = float(model.predict(frame(X, WINDOW_FEATURES, model))[0])
     score = round(clamp(score, 0.0, 100.0), 1)
+    return {"score": score, "level": vulnerability_level(score)}
+
+
+def vulnerability_level(score: float) -> str:
     if score >= 70:
-        level = "high"
-    elif score >= 40:
-        level = "moderate"
-    else:
-        level = "low"
-    return {"score": score, "level": level}
+        return "high"
+    if score >= 40:
+        return "moderate"
+    return "low"
+
+
+def snapshot_metrics(df: pd.DataFrame, ma: pd.DataFrame, buckets: pd.DataFrame) -> pd.DataFrame:
+    # Same metrics as realtime_metrics / moving_averages / adaptive_threshold /
+    # vulnerability_ml, computed for every node at once. df: each node's
+    # latest rows, (node, timestamp) sorted; ma, buckets: from
+    # load_snapshot_aggregates.
+    if df.empty:
+        return pd.DataFrame()
+    df = df.sort_values(["node", "timestamp"], kind="stable").reset_index(drop=True)
+    g = df.groupby("node", sort=True)
+    rank = g.cumcount(ascending=False)
+    secs = df["timestamp"].astype("int64") / 1e9
+
+    out = g[["lat", "lon", "pm25", "pm10"]].last()
+    out["timestamp"] = g["timestamp"].last().astype("int64") // 1_000_000
+    out["ratio"] = (out["pm25"] / out["pm10"]).where(out["pm10"] > 0, 0.0)
+
+    # realtime_metrics: tail(60)
+    rt = df[rank < 60].assign(secs=secs)
+    rt_g = rt.groupby("node", sort=True)
+    dy = rt_g["pm25"].last() - rt_g["pm25"].first()
+    dx = rt_g["secs"].last() - rt_g["secs"].first()
+    out["trend"] = (dy / dx.where(dx != 0)).fillna(0.0) * 3600
+    out["volatility"] = rt_g["pm25"].std().fillna(0.0)
+
+    # moving_averages: windows anchored at each node's latest sample
+    out = out.join(ma[["ma_5m", "ma_15m", "ma_60m"]])
+
+    # adaptive_threshold: tail(360)
+    at_g = df[rank < 360].groupby("node", sort=True)["pm25"]
+    q90 = at_g.quantile(0.9)
+    adaptive = np.maximum(WHO_THRESHOLD, at_g.mean() + at_g.std().fillna(0.0))
+    out["adaptive_threshold"] = np.maximum(adaptive, q90 * 0.9).round(1)
+    for node in out.index:
+        # Same gating as /ai/insights: raw thresholds until the first fill
+        baseline = sketch_baseline(node)
+        if baseline:
+            out.loc[node, "adaptive_threshold"] = adaptive_threshold(df, baseline)["adaptive_threshold"]
+
+    # vulnerability_ml: latest window of 10-minute buckets per node
+    out["vulnerability"] = 0.0
+    bundle = load_model_bundle()
+    model = bundle.get("model_vulnerability") if bundle else None
+    buckets = buckets[buckets["node"].isin(out.index)]
+    if model is not None and not buckets.empty:
+        # Node codes follow out's (sorted) index; buckets are node, bucket sorted
+        codes = out.index.get_indexer(buckets["node"])
+        nodes, X = last_windows(
+            codes, buckets["bucket"].to_numpy(), buckets["pm25"].to_numpy(), buckets["pm10"].to_numpy()
+        )
+        if len(nodes):
+            scores = np.clip(model.predict(frame(X, WINDOW_FEATURES, model)), 0.0, 100.0).round(1)
+            out.iloc[nodes, out.columns.get_loc("vulnerability")] = scores
+
+    out["level"] = out["vulnerability"].map(vulnerability_level)
+    return out.reset_index()
+
+
+def minmax_indices(ts: np.ndarray, y: np.ndarray, pixels: int) -> np.ndarray:
+    # Keeps the first min and first max sample of every pixel column, so the
+    # result has at most 2 * pixels points and peaks are never smoothed away.
+    n = len(ts)
+    if n <= pixels * 2:
+        return np.arange(n)
+    span = int(ts[-1] - ts[0]) + 1
+    pixel = (ts - ts[0]) * pixels // span
+    starts = np.flatnonzero(np.r_[True, pixel[1:] != pixel[:-1]])
+    seg = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, n]))
+    pos = np.arange(n)
+    lo = np.minimum.reduceat(y, starts)
+    hi = np.maximum.reduceat(y, starts)
+    first_lo = np.minimum.reduceat(np.where(y == lo[seg], pos, n), starts)
+    first_hi = np.minimum.reduceat(np.where(y == hi[seg], pos, n), starts)
+    return np.unique(np.concatenate([first_lo, first_hi]))
+
+
+def downsample_history(df: pd.DataFrame, points: int) -> pd.DataFrame:
+    if len(df) <= points:
+        return df
+    ts = df["timestamp"].to_numpy(dtype=np.int64)
+    idx = minmax_indices(ts, df["pm25"].to_numpy(dtype=float), max(points // 2, 1))
+    return df.iloc[idx]
 
 
 def calc_ess(realtime: dict, exposure: dict, forecast: dict) -> float:
@@ -599,16 +1173,46 @@ def advisory(ess: float, forecast: dict, prob: float) -> list[str]:
 
 
 @app.get("/ai/insights")
-def ai_insights(node: str | None = None, hours: int = 24):
-    df = load_recent_data(hours=hours, node=node)
+@profiled
+def ai_insights(node: str | None = None, hours: int = 24, budget_ms: float | None = None):
+    deadline = new_deadline(budget_ms)
+    count_request("insights")
+    degraded: list[str] = []
+    long_window = rollup_state["ready"] and hours > RAW_WINDOW_H
+    df = load_recent_data(hours=RAW_WINDOW_H if long_window else hours, node=node)
+    rows = len(df)
+    profile_tag(rows=rows)
+    baseline = sketch_baseline(node)
+    anomaly = anomaly_status(node)
     realtime = realtime_metrics(df)
-    exposure = exposure_metrics(df)
-    forecast = model_forecast(df)
+    exposure = run_stage(
+        "exposure",
+        rows,
+        deadline,
+        lambda: exposure_windowed(node, df),
+        lambda: exposure_metrics(bucket_means(df)),
+        degraded,
+    )
+    forecast = run_stage(
+        "forecast",
+        rows,
+        deadline,
+        lambda: model_forecast(df, baseline),
+        lambda: simple_forecast(df, HORIZON, baseline),
+        degraded,
+    )
     ma = moving_averages(df)
-    adaptive = adaptive_threshold(df)
-    quality = data_quality(df)
+    adaptive = adaptive_threshold(df, baseline)
+    quality = data_quality_window(node, hours, df) if long_window else data_quality(df)
     recovery = recovery_metrics(df)
-    vulnerability = vulnerability_ml(df)
+    vulnerability = run_stage(
+        "vulnerability",
+        rows,
+        deadline,
+        lambda: vulnerability_ml(df),
+        lambda: {"score": 0.0, "level": "low"},
+        degraded,
+    )
 
     prob = 0.0
     forecast_max = max([v for v in forecast.values() if v is not None] or [0])
@@ -617,9 +1221,16 @@ def ai_insights(node: str | None = None, hours: int = 24):
         prob = min(1.0, (forecast_max - threshold) / max(threshold, 1))
 
     ess = calc_ess(realtime, exposure, forecast)
-    source = source_classifier_ml(df)
+    source = run_stage(
+        "source",
+        rows,
+        deadline,
+        lambda: source_classifier_ml(df),
+        lambda: source_classifier(df),
+        degraded,
+    )
 
-    return {
+    payload = {
         "realtime": realtime,
         "forecast": {
             "h1": forecast.get(1),
@@ -637,54 +1248,245 @@ def ai_insights(node: str | None = None, hours: int = 24):
         "source": source,
         "vulnerability": vulnerability,
         "advisory": advisory(ess, forecast, prob),
+        "anomaly": anomaly,
+        "degraded": degraded,
+    }
+    # A Response is passed through as is: no jsonable_encoder pass
+    return ORJSONResponse(payload)
+
+
+@app.get("/ai/anomalies")
+def ai_anomalies(node: str | None = None, since: int | None = None):
+    if node:
+        return {"node": node, "anomaly": anomaly_status(node, since)}
+    sync_published()
+    return {"active": anomaly_detector.active(), "events": anomaly_detector.recent_events(since)}
+
+
+@app.get("/ai/nodes/snapshot")
+@profiled
+def ai_nodes_snapshot(hours: int = 24):
+    df = load_snapshot_data(hours=hours, window=SNAPSHOT_WINDOW)
+    ma, buckets = load_snapshot_aggregates(hours=hours)
+    profile_tag(rows=len(df))
+    snap = snapshot_metrics(df, ma, buckets)
+    nodes = []
+    for row in snap.itertuples(index=False):
+        nodes.append(
+            {
+                "node": row.node,
+                "lat": row.lat,
+                "lon": row.lon,
+                "timestamp": int(row.timestamp),
+                "pm25": round(float(row.pm25), 1),
+                "pm10": round(float(row.pm10), 1),
+                "ratio": round(float(row.ratio), 2),
+                "trend": round(float(row.trend), 2),
+                "volatility": round(float(row.volatility), 2),
+                "ma_5m": round(float(row.ma_5m), 1),
+                "ma_15m": round(float(row.ma_15m), 1),
+                "ma_60m": round(float(row.ma_60m), 1),
+                "adaptive_threshold": float(row.adaptive_threshold),
+                "vulnerability": float(row.vulnerability),
+                "level": row.level,
+            }
+        )
+    return ORJSONResponse({"count": len(nodes), "nodes": nodes})
+
+
+def table_response(request: Request, payload: dict, tables: tuple[str, ...]) -> Response:
+    # payload[t] for t in tables is columnar ({column: list or array});
+    # plain JSON clients get the usual list of objects.
+    accept = request.headers.get("accept", "")
+    headers = {"Vary": "Accept"}
+    if msgpack is not None and any(t in accept for t in MSGPACK_TYPES):
+        packed = {
+            k: ({c: np.asarray(v).tolist() for c, v in payload[k].items()} if k in tables else v)
+            for k, v in payload.items()
+        }
+        return Response(msgpack.packb(packed), media_type=MSGPACK_TYPES[0], headers=headers)
+    if COLUMNAR_TYPE in accept:
+        return ORJSONResponse(payload, media_type=COLUMNAR_TYPE, headers=headers)
+    for k in tables:
+        columns = payload[k]
+        names = list(columns)
+        payload[k] = [dict(zip(names, row)) for row in zip(*(np.asarray(columns[c]).tolist() for c in names))]
+    return ORJSONResponse(payload, headers=headers)
+
+
+@app.get("/ai/history")
+@profiled
+def ai_history(
+    request: Request,
+    node: str | None = None,
+    from_ms: int | None = Query(None, alias="from"),
+    to_ms: int | None = Query(None, alias="to"),
+    points: int = 1000,
+):
+    points = int(clamp(points, 2, HISTORY_MAX_POINTS))
+    if to_ms is None:
+        to_ms = int(pd.Timestamp.utcnow().timestamp() * 1000)
+    if from_ms is None:
+        from_ms = to_ms - 24 * 3600 * 1000
+    # Coarse zoom: a pixel column spans at least one 10-minute bucket
+    pixel_ms = (to_ms - from_ms) // max(points // 2, 1)
+    coarse = pixel_ms >= BUCKET_MS
+    resolution = "raw"
+    if coarse and rollup_state["ready"]:
+        resolution = tier_for_width(pixel_ms)
+        with db.cursor() as cur:
+            df = bucket_series(cur, node, from_ms, to_ms, resolution)
+    else:
+        if coarse:
+            resolution = "10m"
+        df = load_history_data(
+            from_ms, to_ms, node=node, bucket_ms=BUCKET_MS if coarse else None
+        )
+    rows = len(df)
+    profile_tag(rows=rows)
+    df = downsample_history(df, points)
+    payload = {
+        "node": node,
+        "from": from_ms,
+        "to": to_ms,
+        "resolution": resolution,
+        "rows": rows,
+        "points": len(df),
+        "data": {
+            "timestamp": df["timestamp"].to_numpy(dtype=np.int64),
+            "pm25": df["pm25"].to_numpy(dtype=float).round(1),
+            "pm10": df["pm10"].to_numpy(dtype=float).round(1),
+        },
     }
+    return table_response(request, payload, ("data",))
 
 
 @app.get("/ai/debug")
 def ai_debug():
-    if not DB_URL:
+    if not db.configured():
         return {"db": "missing", "count": 0, "latest_timestamp": None}
-    conn = psycopg2.connect(DB_URL, sslmode="require")
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM sensor_data")
-            count = cur.fetchone()[0]
-            cur.execute("SELECT MAX(timestamp) FROM sensor_data")
-            latest = cur.fetchone()[0]
-    finally:
-        conn.close()
+    with db.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM sensor_data")
+        count = cur.fetchone()[0]
+        cur.execute("SELECT MAX(timestamp) FROM sensor_data")
+        latest = cur.fetchone()[0]
     return {"db": "ok", "count": int(count), "latest_timestamp": latest}
 
 
+@app.get("/ai/metrics")
+def ai_metrics():
+    with metrics_lock:
+        return {
+            "requests": dict(request_counts),
+            "degraded": dict(degraded_counts),
+            "latency_budget_ms": LATENCY_BUDGET_MS,
+            "ingest": ingest_writer.stats(),
+            "model": model_info(),
+        }
+
+
+def parse_ingest(body: bytes, content_type: str | None, content_encoding: str | None):
+    raw = parse_payload(body, content_type, content_encoding)
+    if len(raw) > INGEST_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"Massimo {INGEST_MAX_ROWS} campioni per batch")
+    return validate_batch(raw)
+
+
+def profile_access(request: Request) -> None:
+    token = request.headers.get("x-profile-token") or request.query_params.get("profile")
+    if not authorized(token):
+        raise HTTPException(status_code=403, detail="Non autorizzato")
+
+
+@app.get("/ai/profiles")
+def ai_profiles(request: Request):
+    profile_access(request)
+    paths = sorted(PROFILE_DIR.glob("*.txt"), reverse=True) if PROFILE_DIR.exists() else []
+    return {"profiles": [{"id": p.stem, "summary": p.read_text().split("\n\n", 1)[0]} for p in paths]}
+
+
+@app.get("/ai/profiles/{profile_id}")
+def ai_profile(request: Request, profile_id: str, format: str = "text"):
+    profile_access(request)
+    path = PROFILE_DIR / f"{Path(profile_id).name}.{'folded' if format == 'folded' else 'txt'}"
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="Profilo non trovato")
+    return PlainTextResponse(path.read_text())
+
+
+@app.post("/ingest", status_code=202)
+async def ingest(request: Request):
+    if not db.configured():
+        raise HTTPException(status_code=503, detail="Database non configurato")
+    body = await request.body()
+    try:
+        batch, rejected = await run_in_threadpool(
+            parse_ingest,
+            body,
+            request.headers.get("content-type"),
+            request.headers.get("content-encoding"),
+        )
+    except PayloadTooLarge as exc:
+        raise HTTPException(status_code=413, detail=str(exc))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    ingest_writer.count("rejected", rejected)
+    if not batch.empty and not ingest_writer.submit(batch):
+        raise HTTPException(
+            status_code=429,
+            detail="Coda di scrittura piena",
+            headers={"Retry-After": "1"},
+        )
+    return {"accepted": len(batch), "rejected": rejected}
+
+
 @app.get("/predict")
-def predict(node: str | None = None):
+@profiled
+def predict(request: Request, node: str | None = None, budget_ms: float | None = None):
+    deadline = new_deadline(budget_ms)
+    count_request("predict")
+    degraded: list[str] = []
     df = load_recent_data(hours=6, node=node)
-    forecast = model_forecast(df)
-    forecast_pm10 = model_forecast_pm10(df)
+    rows = len(df)
+    profile_tag(rows=rows)
+    baseline = sketch_baseline(node)
+    fallback = simple_forecast(df, HORIZON_PRED, baseline)
+    forecast = run_stage(
+        "forecast",
+        rows,
+        deadline,
+        lambda: model_forecast(df, baseline),
+        lambda: fallback,
+        degraded,
+    )
+    forecast_pm10 = run_stage(
+        "forecast_pm10",
+        rows,
+        deadline,
+        lambda: model_forecast_pm10(df),
+        lambda: {},
+        degraded,
+    )
     ratio = 1.0
     if not df.empty and float(df["pm10"].iloc[-1]) > 0:
         ratio = float(df["pm25"].iloc[-1]) / float(df["pm10"].iloc[-1])
 
-    pm25_preds = [
-        {"hour": h, "value": forecast.get(h) or simple_forecast(df).get(h)}
-        for h in HORIZON_PRED
-    ]
-    pm10_preds = [
-        {
-            "hour": h,
-            "value": round(
-                forecast_pm10.get(h)
-                if forecast_pm10.get(h) is not None
-                else (forecast.get(h) or simple_forecast(df).get(h) or 0) / max(ratio, 0.1),
-                1,
-            ),
-        }
+    pm25_values = [forecast.get(h) or fallback.get(h) for h in HORIZON_PRED]
+    pm10_values = [
+        round(
+            forecast_pm10.get(h)
+            if forecast_pm10.get(h) is not None
+            else (forecast.get(h) or fallback.get(h) or 0) / max(ratio, 0.1),
+            1,
+        )
         for h in HORIZON_PRED
     ]
 
-    return {
-        "pm25Predictions": pm25_preds,
-        "pm10Predictions": pm10_preds,
+    payload = {
+        "pm25Predictions": {"hour": HORIZON_PRED, "value": pm25_values},
+        "pm10Predictions": {"hour": HORIZON_PRED, "value": pm10_values},
         "trend": "stable",
         "confidence": 80,
+        "degraded": degraded,
     }
+    return table_response(request, payload, ("pm25Predictions", "pm10Predictions"))
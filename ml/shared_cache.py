@@ -0,0 +1,296 @@
+import fcntl
+import json
+import os
+import time
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+import numpy as np
+import db
+
+LAYOUT_VERSION = 1
+RETIRED = -1
+NAME_BYTES = 64
+# header: version, max_nodes, capacity, n_nodes, last_id, heartbeat_ms
+HEADER_SLOTS = 8
+# Postgres SERIAL ids are assigned at insert but become visible at commit,
+# so a poll can see id n + 1 before n: every poll re-reads this many ids
+# below the highest one taken
+POLL_OVERLAP_IDS = 1000
+
+
+def _untrack(shm: shared_memory.SharedMemory) -> None:
+    # The segment outlives any single worker; keep the resource tracker
+    # from unlinking it when the process that created/attached it exits.
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def _size(max_nodes: int, capacity: int) -> int:
+    return 8 * HEADER_SLOTS + NAME_BYTES * max_nodes + 8 * 3 * max_nodes + 8 * 3 * max_nodes * capacity
+
+
+class SharedSampleBuffer:
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        buf = shm.buf
+        self.header = np.ndarray((HEADER_SLOTS,), dtype=np.int64, buffer=buf)
+        max_nodes, capacity = int(self.header[1]), int(self.header[2])
+        self.max_nodes = max_nodes
+        self.capacity = capacity
+        off = 8 * HEADER_SLOTS
+        self.names = np.ndarray((max_nodes, NAME_BYTES), dtype=np.uint8, buffer=buf, offset=off)
+        off += NAME_BYTES * max_nodes
+        # Per node: seqlock counter (odd while writing) and samples appended
+        self.seq = np.ndarray((max_nodes,), dtype=np.int64, buffer=buf, offset=off)
+        off += 8 * max_nodes
+        self.count = np.ndarray((max_nodes,), dtype=np.int64, buffer=buf, offset=off)
+        off += 8 * max_nodes
+        # Ring holds every sample of the node since this time (ms): the
+        # window start when the node was first filled, or just after the
+        # newest sample overwritten since
+        self.covered_from = np.ndarray((max_nodes,), dtype=np.float64, buffer=buf, offset=off)
+        off += 8 * max_nodes
+        # timestamp ms, pm25, pm10
+        self.data = np.ndarray((max_nodes, capacity, 3), dtype=np.float64, buffer=buf, offset=off)
+        self.index: dict[str, int] = {}
+
+    @classmethod
+    def create(cls, name: str, max_nodes: int, capacity: int) -> "SharedSampleBuffer":
+        try:
+            existing = cls.attach(name)
+        except FileNotFoundError:
+            existing = None
+        if existing is not None:
+            if existing.max_nodes == max_nodes and existing.capacity == capacity:
+                # Taking over from a writer that may have died mid-append
+                existing.seq[existing.seq % 2 == 1] += 1
+                return existing
+            # Different sizing: retire it so attached readers re-attach
+            existing.header[0] = RETIRED
+            existing.shm.unlink()
+            existing.shm.close()
+        shm = shared_memory.SharedMemory(name=name, create=True, size=_size(max_nodes, capacity))
+        _untrack(shm)
+        header = np.ndarray((HEADER_SLOTS,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[1], header[2] = max_nodes, capacity
+        header[0] = LAYOUT_VERSION
+        return cls(shm)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedSampleBuffer | None":
+        shm = shared_memory.SharedMemory(name=name)
+        _untrack(shm)
+        header = np.ndarray((HEADER_SLOTS,), dtype=np.int64, buffer=shm.buf)
+        if int(header[0]) != LAYOUT_VERSION:
+            shm.close()
+            return None
+        return cls(shm)
+
+    @property
+    def retired(self) -> bool:
+        return int(self.header[0]) != LAYOUT_VERSION
+
+    @property
+    def last_id(self) -> int:
+        return int(self.header[4])
+
+    def heartbeat(self, last_id: int | None = None) -> None:
+        if last_id is not None:
+            self.header[4] = last_id
+        self.header[5] = int(time.time() * 1000)
+
+    def is_fresh(self, max_age_ms: int) -> bool:
+        return time.time() * 1000 - int(self.header[5]) <= max_age_ms
+
+    def node_index(self, node: str, create: bool = False) -> int | None:
+        idx = self.index.get(node)
+        if idx is not None:
+            return idx
+        n = int(self.header[3])
+        for i in range(len(self.index), n):
+            raw = bytes(self.names[i]).rstrip(b"\0").decode("utf-8", "replace")
+            self.index[raw] = i
+        idx = self.index.get(node)
+        if idx is not None or not create or n >= self.max_nodes:
+            return idx
+        encoded = node.encode("utf-8")[:NAME_BYTES]
+        self.names[n, :] = 0
+        self.names[n, : len(encoded)] = np.frombuffer(encoded, dtype=np.uint8)
+        self.count[n] = 0
+        self.covered_from[n] = np.inf
+        self.header[3] = n + 1
+        self.index[node] = n
+        return n
+
+    def append(self, node: str, rows: np.ndarray, covered_from: float | None = None) -> None:
+        # Single writer: rows are (timestamp ms, pm25, pm10)
+        idx = self.node_index(node, create=True)
+        if idx is None or len(rows) == 0:
+            return
+        self.seq[idx] += 1
+        start = int(self.count[idx])
+        if start == 0 and covered_from is not None:
+            self.covered_from[idx] = covered_from
+        total = start + len(rows)
+        # Rows can arrive out of timestamp order (late flushes), so what is
+        # lost is tracked by timestamp, not by position
+        evicted = -np.inf
+        if len(rows) > self.capacity:
+            evicted = float(rows[: -self.capacity, 0].max())
+            rows = rows[-self.capacity :]
+        pos = (total - len(rows) + np.arange(len(rows))) % self.capacity
+        overwritten = pos if start >= self.capacity else pos[pos < start]
+        if overwritten.size:
+            evicted = max(evicted, float(self.data[idx, overwritten, 0].max()))
+        self.data[idx, pos] = rows
+        self.count[idx] = total
+        if evicted > -np.inf:
+            self.covered_from[idx] = max(float(self.covered_from[idx]), evicted + 1.0)
+        self.seq[idx] += 1
+
+    def clear(self) -> None:
+        # Readers see empty rings (and fall back to the DB) until refilled
+        for idx in range(int(self.header[3])):
+            self.seq[idx] += 1
+            self.count[idx] = 0
+            self.covered_from[idx] = np.inf
+            self.seq[idx] += 1
+
+    def read(self, node: str) -> tuple[float, np.ndarray] | None:
+        idx = self.node_index(node)
+        if idx is None:
+            return None
+        for _ in range(10):
+            before = int(self.seq[idx])
+            if before % 2:
+                continue
+            n = min(int(self.count[idx]), self.capacity)
+            rows = self.data[idx, :n].copy()
+            covered = float(self.covered_from[idx])
+            if int(self.seq[idx]) == before:
+                return covered, rows[np.argsort(rows[:, 0], kind="stable")]
+        return None
+
+
+def acquire_leader_lock(name: str):
+    # Whoever holds the lock fills the buffer; it is released when the
+    # process dies, so another worker can take over.
+    fh = open(Path("/tmp") / f"{name}.lock", "w")
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fh.close()
+        return None
+    fh.write(str(os.getpid()))
+    fh.flush()
+    return fh
+
+
+class IdPoller:
+    # Tracks which sensor_data ids were taken, re-reading POLL_OVERLAP_IDS
+    # below the highest one so rows committed late are not skipped.
+    def __init__(self, last_id: int = 0, seen=None):
+        self.last_id = int(last_id)
+        # Without the ids actually taken near last_id, assume all of them were
+        self.base = self.last_id if seen is None else 0
+        self.seen = {int(i) for i in seen} if seen is not None else set()
+
+    @classmethod
+    def at_head(cls, cur) -> "IdPoller":
+        # Start after every row visible now
+        cur.execute("SELECT MAX(id) FROM sensor_data")
+        max_id = cur.fetchone()[0] or 0
+        cur.execute(db.sql("SELECT id FROM sensor_data WHERE id > %s AND id <= %s"), (max_id - POLL_OVERLAP_IDS, max_id))
+        return cls(max_id, seen=[r[0] for r in cur.fetchall()])
+
+    def position(self) -> tuple[int, list[int]]:
+        return self.last_id, sorted(self.seen)
+
+    def floor(self) -> int:
+        return max(self.last_id - POLL_OVERLAP_IDS, self.base)
+
+    def take(self, rows: list) -> list:
+        # rows: (id, ...) sorted by id; returns those not taken before
+        floor = self.floor()
+        fresh = [r for r in rows if r[0] > floor and r[0] not in self.seen]
+        if fresh:
+            self.last_id = max(self.last_id, int(fresh[-1][0]))
+            self.seen.update(int(r[0]) for r in fresh)
+            floor = self.floor()
+            self.seen = {i for i in self.seen if i > floor}
+        return fresh
+
+
+def poll_rows(cur, pollers: list[IdPoller], limit: int = 50_000) -> list:
+    # One query for every poller; rows are (id, node, timestamp, pm25, pm10).
+    # Picked up by id, so late samples with old timestamps still land.
+    cur.execute(
+        db.sql(
+            "SELECT id, node, timestamp, pm25, pm10 FROM sensor_data "
+            "WHERE id > %s ORDER BY id ASC LIMIT %s"
+        ),
+        (min(p.floor() for p in pollers), limit),
+    )
+    return cur.fetchall()
+
+
+def publish_state(name: str, state: dict) -> None:
+    # State the leader computes from the poll, for the other workers
+    path = Path("/tmp") / f"{name}.state.json"
+    tmp = path.with_name(path.name + f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(state))
+    tmp.replace(path)
+
+
+def read_state(name: str, known_mtime: int | None) -> tuple[int, dict] | None:
+    # (mtime, state) when the leader published since known_mtime
+    path = Path("/tmp") / f"{name}.state.json"
+    try:
+        mtime = path.stat().st_mtime_ns
+        if mtime == known_mtime:
+            return None
+        return mtime, json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _append_rows(buffer: SharedSampleBuffer, rows: list, covered_from: float | None) -> None:
+    if not rows:
+        return
+    nodes = np.array([r[1] for r in rows], dtype=str)
+    values = np.array([r[2:] for r in rows], dtype=np.float64)
+    uniq, inverse = np.unique(nodes, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.searchsorted(inverse[order], np.arange(len(uniq) + 1))
+    for i, node in enumerate(uniq):
+        buffer.append(str(node), values[order[bounds[i] : bounds[i + 1]]], covered_from)
+
+
+def bootstrap_buffer(buffer: SharedSampleBuffer, cur, since_ms: int) -> IdPoller:
+    # (Re)fill the rings from the DB; also done on takeover, since the
+    # previous writer's overlap state is unknown
+    buffer.clear()
+    cur.execute("SELECT MAX(id) FROM sensor_data")
+    max_id = cur.fetchone()[0] or 0
+    cur.execute(
+        db.sql(
+            "SELECT id, node, timestamp, pm25, pm10 FROM sensor_data "
+            "WHERE (timestamp >= %s OR id > %s) AND id <= %s ORDER BY id ASC"
+        ),
+        (since_ms, max_id - POLL_OVERLAP_IDS, max_id),
+    )
+    rows = cur.fetchall()
+    _append_rows(buffer, [r for r in rows if r[2] >= since_ms], since_ms)
+    buffer.heartbeat(int(max_id))
+    return IdPoller(max_id, seen=[r[0] for r in rows if r[0] > max_id - POLL_OVERLAP_IDS])
+
+
+def poll_buffer(buffer: SharedSampleBuffer, poller: IdPoller, rows: list, since_ms: int) -> int:
+    fresh = poller.take(rows)
+    # Nodes first seen now had no samples before, back to since_ms
+    _append_rows(buffer, fresh, since_ms)
+    buffer.heartbeat(poller.last_id)
+    return len(fresh)
@@ -0,0 +1,226 @@
+import threading
+from pathlib import Path
+import numpy as np
+
+METRICS = ("pm25", "pm10")
+
+# Log-spaced bins (relative accuracy ~2%), mergeable by plain addition
+SKETCH_MIN = 0.1
+SKETCH_MAX = 2000.0
+SKETCH_GAMMA = 1.04
+SKETCH_BINS = int(np.ceil(np.log(SKETCH_MAX / SKETCH_MIN) / np.log(SKETCH_GAMMA))) + 1
+
+# Ring tiers: (name, slot width ms, slots kept)
+TIERS = [
+    ("10min", 10 * 60 * 1000, 7),
+    ("1h", 3600 * 1000, 25),
+    ("1d", 24 * 3600 * 1000, 31),
+]
+# Horizon -> (tier, slots). Windows are slot-aligned: the current partial
+# slot plus the previous ones.
+HORIZONS = {
+    "1h": ("10min", 6),
+    "24h": ("1h", 24),
+    "7d": ("1d", 7),
+    "30d": ("1d", 30),
+}
+LONGEST_HORIZON_MS = 30 * 24 * 3600 * 1000
+
+_TIER_OFFSET = {}
+_offset = 0
+for _name, _width, _slots in TIERS:
+    _TIER_OFFSET[_name] = _offset
+    _offset += _slots
+TOTAL_SLOTS = _offset
+
+
+def bin_index(values: np.ndarray) -> np.ndarray:
+    v = np.asarray(values, dtype=float)
+    safe = np.maximum(v, SKETCH_MIN)
+    idx = np.ceil(np.log(safe / SKETCH_MIN) / np.log(SKETCH_GAMMA)).astype(np.int64)
+    return np.clip(idx, 0, SKETCH_BINS - 1)
+
+
+def bin_value(idx: np.ndarray | int) -> np.ndarray:
+    # Midpoint of (MIN * g^(i-1), MIN * g^i] with the same relative error on both ends
+    return 2.0 * SKETCH_MIN * np.power(SKETCH_GAMMA, idx) / (SKETCH_GAMMA + 1.0)
+
+
+def hist_quantile(hist: np.ndarray, q: float) -> float | None:
+    total = int(hist.sum())
+    if total == 0:
+        return None
+    cum = np.cumsum(hist)
+    idx = int(np.searchsorted(cum, q * (total - 1), side="right"))
+    return float(bin_value(min(idx, SKETCH_BINS - 1)))
+
+
+def empty_state() -> dict:
+    return {
+        "last_seen": -1,
+        "slot_ids": np.full(TOTAL_SLOTS, -1, dtype=np.int64),
+        "hist": np.zeros((len(METRICS), TOTAL_SLOTS, SKETCH_BINS), dtype=np.int32),
+        # count, sum, sumsq per metric and slot
+        "stats": np.zeros((len(METRICS), TOTAL_SLOTS, 3), dtype=np.float64),
+    }
+
+
+def update_state(state: dict, ts_ms: np.ndarray, values: dict) -> None:
+    ts_ms = np.asarray(ts_ms, dtype=np.int64)
+    if ts_ms.size == 0:
+        return
+    bins = {m: bin_index(values[m]) for m in METRICS}
+    vals = {m: np.asarray(values[m], dtype=float) for m in METRICS}
+
+    for name, width, slots in TIERS:
+        off = _TIER_OFFSET[name]
+        slot = ts_ms // width
+        newest = max(int(slot.max()), int(state["slot_ids"][off : off + slots].max()))
+        keep = slot > newest - slots
+        if not keep.any():
+            continue
+        slot = slot[keep]
+        pos = off + slot % slots
+
+        # Recycle ring positions that now belong to a newer slot, drop
+        # samples older than what the position holds.
+        incoming = np.full(TOTAL_SLOTS, -1, dtype=np.int64)
+        np.maximum.at(incoming, pos, slot)
+        recycled = incoming > state["slot_ids"]
+        if recycled.any():
+            state["slot_ids"][recycled] = incoming[recycled]
+            state["hist"][:, recycled, :] = 0
+            state["stats"][:, recycled, :] = 0.0
+        valid = slot == state["slot_ids"][pos]
+        pos = pos[valid]
+        if pos.size == 0:
+            continue
+
+        for mi, m in enumerate(METRICS):
+            b = bins[m][keep][valid]
+            v = vals[m][keep][valid]
+            flat = np.bincount(pos * SKETCH_BINS + b, minlength=TOTAL_SLOTS * SKETCH_BINS)
+            state["hist"][mi] += flat.reshape(TOTAL_SLOTS, SKETCH_BINS).astype(np.int32)
+            state["stats"][mi, :, 0] += np.bincount(pos, minlength=TOTAL_SLOTS)
+            state["stats"][mi, :, 1] += np.bincount(pos, weights=v, minlength=TOTAL_SLOTS)
+            state["stats"][mi, :, 2] += np.bincount(pos, weights=v * v, minlength=TOTAL_SLOTS)
+
+    state["last_seen"] = max(int(state["last_seen"]), int(ts_ms.max()))
+
+
+def summarize_state(state: dict, horizon: str) -> dict | None:
+    if state["last_seen"] < 0:
+        return None
+    tier, k = HORIZONS[horizon]
+    _, width, slots = next(t for t in TIERS if t[0] == tier)
+    off = _TIER_OFFSET[tier]
+    current = state["last_seen"] // width
+    ids = state["slot_ids"][off : off + slots]
+    mask = (ids > current - k) & (ids <= current)
+    if not mask.any():
+        return None
+
+    out = {"horizon": horizon}
+    for mi, m in enumerate(METRICS):
+        hist = state["hist"][mi, off : off + slots][mask].sum(axis=0)
+        count, total, sumsq = state["stats"][mi, off : off + slots][mask].sum(axis=0)
+        if count == 0:
+            return None
+        mean = total / count
+        var = (sumsq - count * mean * mean) / (count - 1) if count > 1 else 0.0
+        out[m] = {
+            "count": int(count),
+            "mean": float(mean),
+            "std": float(np.sqrt(max(var, 0.0))),
+            "q10": hist_quantile(hist, 0.1),
+            "q50": hist_quantile(hist, 0.5),
+            "q90": hist_quantile(hist, 0.9),
+        }
+    return out
+
+
+class SketchStore:
+    def __init__(self, path: Path | None = None):
+        self.path = path
+        self.states: dict[str, dict] = {}
+        self.lock = threading.Lock()
+        # Set by updates, cleared by save(); the server saves periodically
+        # from its background thread, never from update()
+        self._dirty = False
+        # (last sensor_data id, ids taken just below it): which rows the
+        # saved state already counts, so a restart neither skips nor
+        # double counts any
+        self.position: tuple[int, list[int]] | None = None
+
+    def last_seen(self, key: str) -> int | None:
+        state = self.states.get(key)
+        if state is None or state["last_seen"] < 0:
+            return None
+        return int(state["last_seen"])
+
+    def update(self, key: str, ts_ms: np.ndarray, pm25: np.ndarray, pm10: np.ndarray) -> None:
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                state = self.states[key] = empty_state()
+            update_state(state, ts_ms, {"pm25": pm25, "pm10": pm10})
+            self._dirty = True
+
+    def summary(self, key: str, horizon: str) -> dict | None:
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                return None
+            return summarize_state(state, horizon)
+
+    def summaries(self, horizon: str) -> dict[str, dict | None]:
+        with self.lock:
+            return {key: summarize_state(state, horizon) for key, state in self.states.items()}
+
+    def clear(self) -> None:
+        with self.lock:
+            self.states = {}
+            self.position = None
+            self._dirty = True
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self.lock:
+            if not self._dirty:
+                return
+            keys = sorted(self.states)
+            arrays = {
+                "keys": np.array(keys, dtype=str),
+                "last_seen": np.array([self.states[k]["last_seen"] for k in keys], dtype=np.int64),
+                "slot_ids": np.array([self.states[k]["slot_ids"] for k in keys], dtype=np.int64),
+                "hist": np.array([self.states[k]["hist"] for k in keys], dtype=np.int32),
+                "stats": np.array([self.states[k]["stats"] for k in keys], dtype=np.float64),
+                "layout": np.array([SKETCH_BINS, TOTAL_SLOTS], dtype=np.int64),
+            }
+            if self.position is not None:
+                arrays["poll_last_id"] = np.array(self.position[0], dtype=np.int64)
+                arrays["poll_seen"] = np.array(self.position[1], dtype=np.int64)
+            self._dirty = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp.npz")
+        np.savez_compressed(tmp, **arrays)
+        tmp.replace(self.path)
+
+    def load(self) -> None:
+        if not self.path or not self.path.exists():
+            return
+        data = np.load(self.path, allow_pickle=False)
+        # Bin/slot layout changed since the file was written: start fresh
+        if list(data["layout"]) != [SKETCH_BINS, TOTAL_SLOTS]:
+            return
+        with self.lock:
+            for i, key in enumerate(data["keys"]):
+                self.states[str(key)] = {
+                    "last_seen": int(data["last_seen"][i]),
+                    "slot_ids": data["slot_ids"][i].astype(np.int64),
+                    "hist": data["hist"][i].astype(np.int32),
+                    "stats": data["stats"][i].astype(np.float64),
+                }
+            if "poll_last_id" in data.files:
+                self.position = (int(data["poll_last_id"]), data["poll_seen"].tolist())
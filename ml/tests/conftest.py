@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Modules in ml/ are imported flat, as when run from that directory
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,114 @@
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+import db
+import rollups
+
+T0 = 1_700_000_000_000
+MIN_MS = 60 * 1000
+HOUR_MS = 60 * MIN_MS
+
+
+@pytest.fixture
+def cur(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_URL", None)
+    monkeypatch.setattr(db, "SQLITE_PATH", str(tmp_path / "rollups.db"))
+    conn = sqlite3.connect(db.SQLITE_PATH)
+    db.ensure_schema(conn)
+    cur = conn.cursor()
+    rollups.ensure_rollup_schema(cur)
+    yield cur
+    conn.close()
+
+
+def samples(node: str, start_ms: int, end_ms: int, step_ms: int = 10_000, seed: int = 0) -> list[tuple]:
+    rng = np.random.default_rng(seed)
+    ts = np.arange(start_ms, end_ms, step_ms) + rng.integers(0, step_ms // 2, size=len(range(start_ms, end_ms, step_ms)))
+    pm25 = 10 + 30 * rng.random(len(ts))
+    return [(node, float(a), float(a * 1.6), 45.0, 9.0, int(t)) for a, t in zip(pm25, ts)]
+
+
+def insert(cur, rows: list[tuple]) -> None:
+    cur.executemany("INSERT INTO sensor_data (node, pm25, pm10, lat, lon, timestamp) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+def raw_frame(cur) -> pd.DataFrame:
+    cur.execute("SELECT node, pm25, pm10, timestamp FROM sensor_data")
+    raw = pd.DataFrame(cur.fetchall(), columns=["node", "pm25", "pm10", "timestamp"])
+    raw = raw.sort_values(["node", "timestamp"], kind="stable").reset_index(drop=True)
+    raw["gap"] = raw.groupby("node")["timestamp"].diff(-1).fillna(0).abs()
+    return raw
+
+
+def expected_stats(raw: pd.DataFrame, node: str, a: int, b: int) -> dict:
+    sub = raw[(raw["node"] == node) & (raw["timestamp"] >= a) & (raw["timestamp"] < b)]
+    return {
+        "samples": len(sub),
+        "pm25_mean": sub["pm25"].mean(),
+        "pm25_std": sub["pm25"].std(),
+        "pm10_min": sub["pm10"].min(),
+        "pm10_max": sub["pm10"].max(),
+        "exposure": (sub["pm25"] * sub["gap"]).sum() / HOUR_MS,
+        "exposure_hours": sub["gap"].sum() / HOUR_MS,
+    }
+
+
+def assert_matches_raw(cur, windows: list[tuple[str, int, int]]) -> None:
+    assert rollups.verify(cur, windows=100) == []
+    raw = raw_frame(cur)
+    for node, a, b in windows:
+        stats = rollups.window_stats(cur, node, a, b)
+        for key, value in expected_stats(raw, node, a, b).items():
+            assert stats[key] == pytest.approx(value, rel=1e-6, abs=1e-6), (node, a, b, key)
+
+
+def test_tiers_match_raw(cur):
+    insert(cur, samples("a", T0, T0 + 30 * HOUR_MS, seed=1) + samples("b", T0 + 5 * MIN_MS, T0 + 30 * HOUR_MS, 60_000, seed=2))
+    rolled = rollups.refresh_rollups(cur, now_ms=T0 + 30 * HOUR_MS)
+    assert rolled["1d"] > T0
+    assert_matches_raw(cur, [("a", T0, T0 + 30 * HOUR_MS), ("b", T0 + 7 * MIN_MS, T0 + 26 * HOUR_MS + 123)])
+
+
+def test_outage_gap_is_rolled_again(cur):
+    # Node a goes silent for 2 h; its last sample before the outage is rolled
+    # while the next one does not exist yet
+    insert(cur, samples("a", T0, T0 + 10 * HOUR_MS, seed=3))
+    rollups.refresh_rollups(cur, now_ms=T0 + 11 * HOUR_MS)
+    insert(cur, samples("a", T0 + 12 * HOUR_MS, T0 + 28 * HOUR_MS, seed=4))
+    rollups.refresh_rollups(cur, now_ms=T0 + 28 * HOUR_MS)
+    assert_matches_raw(cur, [("a", T0 + 4 * HOUR_MS, T0 + 28 * HOUR_MS), ("a", T0, T0 + 27 * HOUR_MS)])
+
+
+def test_late_rows_are_rolled(cur):
+    # A gateway flushes node b's buffer after its buckets were already rolled
+    insert(cur, samples("a", T0, T0 + 26 * HOUR_MS, seed=5))
+    insert(cur, samples("b", T0, T0 + 2 * HOUR_MS, seed=6))
+    rollups.refresh_rollups(cur, now_ms=T0 + 26 * HOUR_MS)
+    insert(cur, samples("b", T0 + 2 * HOUR_MS, T0 + 25 * HOUR_MS, seed=7))
+    # ...and a few rows that fill an earlier gap of node a
+    insert(cur, [("a", 20.0, 30.0, 45.0, 9.0, T0 + 3 * HOUR_MS + 1)])
+    rollups.refresh_rollups(cur, now_ms=T0 + 26 * HOUR_MS)
+    assert_matches_raw(cur, [("b", T0, T0 + 26 * HOUR_MS), ("b", T0 + 5 * HOUR_MS, T0 + 6 * HOUR_MS), ("a", T0, T0 + 26 * HOUR_MS)])
+
+
+def test_refresh_is_idempotent(cur):
+    insert(cur, samples("a", T0, T0 + 3 * HOUR_MS, seed=8))
+    first = rollups.refresh_rollups(cur, now_ms=T0 + 3 * HOUR_MS)
+    assert rollups.refresh_rollups(cur, now_ms=T0 + 3 * HOUR_MS) == first
+    cur.execute("SELECT COUNT(*), SUM(samples) FROM sensor_rollup_10m")
+    buckets, total = cur.fetchone()
+    cur.execute("SELECT COUNT(*) FROM sensor_data WHERE timestamp < ?", (first["10m"],))
+    assert total == cur.fetchone()[0]
+    assert buckets == len({(ts // rollups.ROLLUP_TIERS[0][1]) for ts in range(T0, first["10m"], 10_000)})
+
+
+def test_bucket_series_matches_raw(cur):
+    insert(cur, samples("a", T0, T0 + 5 * HOUR_MS, seed=9))
+    rollups.refresh_rollups(cur, now_ms=T0 + 4 * HOUR_MS)
+    got = rollups.bucket_series(cur, "a", T0, T0 + 5 * HOUR_MS, "1h")
+    raw = raw_frame(cur)
+    raw = raw[raw["timestamp"] <= T0 + 5 * HOUR_MS]
+    expected = raw.groupby(raw["timestamp"] // HOUR_MS * HOUR_MS)[["pm25", "pm10"]].mean()
+    assert got["timestamp"].tolist() == expected.index.tolist()
+    assert np.allclose(got["pm25"], expected["pm25"]) and np.allclose(got["pm10"], expected["pm10"])
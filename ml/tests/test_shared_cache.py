@@ -0,0 +1,54 @@
+import os
+from multiprocessing import resource_tracker
+import numpy as np
+import pytest
+import shared_cache
+from shared_cache import IdPoller, SharedSampleBuffer
+
+
+@pytest.fixture
+def buffer():
+    name = f"test_cache_{os.getpid()}"
+    buffer = SharedSampleBuffer.create(name, 4, 5)
+    yield buffer
+    buffer.shm.close()
+    # create() untracks the segment; unlink() expects it tracked
+    resource_tracker.register(buffer.shm._name, "shared_memory")
+    buffer.shm.unlink()
+
+
+def rows(ts: list[float]) -> np.ndarray:
+    return np.array([[t, 10.0, 16.0] for t in ts])
+
+
+def test_coverage_after_out_of_order_eviction(buffer):
+    buffer.append("a", rows([10, 20, 30]), 5)
+    assert buffer.read("a")[0] == 5
+    # A late sample (5) is kept, 10 is overwritten: coverage cannot start
+    # at min(ts in ring) = 5 anymore
+    buffer.append("a", rows([40, 5, 50]))
+    covered_from, data = buffer.read("a")
+    assert covered_from == 11
+    assert sorted(data[:, 0]) == [5, 20, 30, 40, 50]
+    # Batch larger than the ring: dropped rows count as evicted too
+    buffer.append("a", rows([1, 2, 3, 4, 5, 6, 7, 100]))
+    assert buffer.read("a")[0] == 51
+
+
+def test_clear_resets_coverage(buffer):
+    buffer.append("a", rows(range(1, 9)), 0)
+    buffer.clear()
+    buffer.append("a", rows([7, 8]), 6)
+    covered_from, data = buffer.read("a")
+    assert covered_from == 6 and sorted(data[:, 0]) == [7, 8]
+
+
+def test_poller_picks_up_late_commits(monkeypatch):
+    monkeypatch.setattr(shared_cache, "POLL_OVERLAP_IDS", 3)
+    poller = IdPoller(0, seen=[])
+    assert [r[0] for r in poller.take([(1,), (2,), (4,)])] == [1, 2, 4]
+    # id 3 committed after 4: still inside the overlap window
+    assert [r[0] for r in poller.take([(2,), (3,), (4,), (5,)])] == [3, 5]
+    assert poller.floor() == 2 and poller.seen == {3, 4, 5}
+    # Without the ids taken, nothing below last_id is re-read
+    assert IdPoller(10).floor() == 10
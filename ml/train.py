@@ -3,11 +3,13 @@ import os
 import sqlite3
 from datetime import datetime, timezone
 from pathlib import Path
+import numpy as np
 import pandas as pd
 from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor, RandomForestClassifier
 from sklearn.metrics import r2_score
 import joblib
 import psycopg2
+from features import FEATURE_SCHEMA, LAG_FEATURES, LAGS, WINDOW, WINDOW_FEATURES, bin_samples, frame, lag_features, window_features
 
 
 def load_binned_series(db_path: Path | None = None, node: str | None = None) -> pd.DataFrame:
@@ -41,125 +43,63 @@ def load_binned_series(db_path: Path | None = None, node: str | None = None) ->
     if df.empty:
         return df
 
-    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ms", utc=True)
-    df["bucket"] = df["timestamp"].dt.floor("10min")
-
-    binned = (
-        df.groupby("bucket", as_index=False)[["pm25", "pm10"]]
-        .mean()
-        .sort_values("bucket")
+    # Same 10-minute means as serve.py computes per request
+    bucket, pm25, pm10 = bin_samples(
+        df["timestamp"].to_numpy(dtype=np.int64), df["pm25"].to_numpy(dtype=float), df["pm10"].to_numpy(dtype=float)
     )
-    return binned
-
-
-def build_features(binned: pd.DataFrame, lags: int = 6) -> tuple[pd.DataFrame, pd.Series, pd.Series]:
-    df = binned.copy()
-    for i in range(1, lags + 1):
-        df[f"pm25_lag_{i}"] = df["pm25"].shift(i)
-        df[f"pm10_lag_{i}"] = df["pm10"].shift(i)
-
-    df["pm25_roll_3"] = df["pm25"].shift(1).rolling(3).mean()
-    df["pm25_roll_6"] = df["pm25"].shift(1).rolling(6).mean()
-    df["pm25_std_6"] = df["pm25"].shift(1).rolling(6).std()
-    df["pm10_roll_3"] = df["pm10"].shift(1).rolling(3).mean()
-    df["pm10_roll_6"] = df["pm10"].shift(1).rolling(6).mean()
-    df["pm10_std_6"] = df["pm10"].shift(1).rolling(6).std()
-    df["pm25_diff_1"] = df["pm25"].diff()
-    df["pm10_diff_1"] = df["pm10"].diff()
-
-    df["hour_of_day"] = df["bucket"].dt.hour
-    df["day_of_week"] = df["bucket"].dt.dayofweek
-
-    df = df.dropna().reset_index(drop=True)
-    feature_cols = [c for c in df.columns if c.startswith("pm25_lag_") or c.startswith("pm10_lag_")]
-    feature_cols += [
-        "pm25_roll_3",
-        "pm25_roll_6",
-        "pm25_std_6",
-        "pm10_roll_3",
-        "pm10_roll_6",
-        "pm10_std_6",
-        "pm25_diff_1",
-        "pm10_diff_1",
-        "hour_of_day",
-        "day_of_week",
-    ]
-
-    X = df[feature_cols]
-    y_pm25 = df["pm25"]
-    y_pm10 = df["pm10"]
+    return pd.DataFrame({"bucket": bucket, "pm25": pm25, "pm10": pm10})
+
+
+def bucket_ms(binned: pd.DataFrame) -> np.ndarray:
+    return binned["bucket"].to_numpy(dtype=np.int64)
+
+
+def build_features(binned: pd.DataFrame) -> tuple[pd.DataFrame, pd.Series, pd.Series]:
+    # The lag count is part of the feature schema (features.LAGS): the
+    # first LAGS buckets have no full history and get no row
+    pm25 = binned["pm25"].to_numpy(dtype=float)
+    pm10 = binned["pm10"].to_numpy(dtype=float)
+    X = frame(lag_features(bucket_ms(binned), pm25, pm10), LAG_FEATURES)
+    y_pm25 = pd.Series(pm25[LAGS:], name="pm25")
+    y_pm10 = pd.Series(pm10[LAGS:], name="pm10")
     return X, y_pm25, y_pm10
 
 
-def label_source(ratio: float, delta: float, duration_min: float, pm25: float, pm10: float) -> str:
-    if ratio > 0.8 and delta > 5:
-        return "combustion_dominant"
-    if ratio < 0.5 and pm10 > pm25 * 1.8:
-        return "coarse_particle"
-    if delta > 8 and duration_min < 30:
-        return "indoor_activity"
-    if delta < 5 and duration_min > 60:
-        return "background_elevation"
-    if delta > 12 and duration_min < 10:
-        return "anomalous_spike"
-    # Avoid "unknown" for training labels to reduce undecided outputs
-    return "background_elevation"
+def label_source(ratio, delta, duration_min, pm25, pm10) -> np.ndarray:
+    # First matching rule wins; "unknown" is avoided for training labels to
+    # reduce undecided outputs
+    return np.select(
+        [
+            (ratio > 0.8) & (delta > 5),
+            (ratio < 0.5) & (pm10 > pm25 * 1.8),
+            (delta > 8) & (duration_min < 30),
+            (delta < 5) & (duration_min > 60),
+            (delta > 12) & (duration_min < 10),
+        ],
+        ["combustion_dominant", "coarse_particle", "indoor_activity", "background_elevation", "anomalous_spike"],
+        default="background_elevation",
+    )
 
 
-def build_window_features(binned: pd.DataFrame, window: int = 6) -> pd.DataFrame:
+def build_window_features(binned: pd.DataFrame, window: int = WINDOW) -> pd.DataFrame:
     if binned.empty or len(binned) < window:
         return pd.DataFrame()
-    rows = []
-    for i in range(window - 1, len(binned)):
-        win = binned.iloc[i - window + 1 : i + 1].copy()
-        t0 = win["bucket"].iloc[0]
-        t1 = win["bucket"].iloc[-1]
-        duration_min = max((t1 - t0).total_seconds() / 60.0, 1)
-        pm25_last = float(win["pm25"].iloc[-1])
-        pm10_last = float(win["pm10"].iloc[-1])
-        ratio = pm25_last / pm10_last if pm10_last > 0 else 0
-        delta = pm25_last - float(win["pm25"].iloc[0])
-        trend = (delta / duration_min) * 60.0
-        volatility = float(win["pm25"].std()) if len(win) > 1 else 0.0
-        avg_pm25 = float(win["pm25"].mean())
-        avg_pm10 = float(win["pm10"].mean())
-        max_pm25 = float(win["pm25"].max())
-        min_pm25 = float(win["pm25"].min())
-        spike = max_pm25 - avg_pm25
-        rows.append(
-            {
-                "pm25_last": pm25_last,
-                "pm10_last": pm10_last,
-                "ratio": ratio,
-                "delta": delta,
-                "trend": trend,
-                "volatility": volatility,
-                "avg_pm25": avg_pm25,
-                "avg_pm10": avg_pm10,
-                "max_pm25": max_pm25,
-                "min_pm25": min_pm25,
-                "spike": spike,
-                "duration_min": duration_min,
-                "label": label_source(ratio, delta, duration_min, pm25_last, pm10_last),
-            }
-        )
-    return pd.DataFrame(rows)
+    X = window_features(
+        bucket_ms(binned), binned["pm25"].to_numpy(dtype=float), binned["pm10"].to_numpy(dtype=float), window
+    )
+    df = frame(X, WINDOW_FEATURES)
+    df["label"] = label_source(df["ratio"], df["delta"], df["duration_min"], df["pm25_last"], df["pm10_last"])
+    return df
 
 
-def vulnerability_score(row: pd.Series) -> float:
-    def clamp(v: float, lo: float, hi: float) -> float:
-        return max(lo, min(hi, v))
-    avg = row["avg_pm25"]
-    trend = abs(row["trend"])
-    vol = row["volatility"]
-    ratio = row["ratio"]
+def vulnerability_score(df: pd.DataFrame) -> np.ndarray:
     base = (
-        0.45 * clamp(avg / 50.0, 0, 1)
-        + 0.25 * clamp(trend / 20.0, 0, 1)
-        + 0.2 * clamp(vol / 6.0, 0, 1)
-        + 0.1 * clamp(ratio / 1.2, 0, 1)
+        0.45 * np.clip(df["avg_pm25"] / 50.0, 0, 1)
+        + 0.25 * np.clip(df["trend"].abs() / 20.0, 0, 1)
+        + 0.2 * np.clip(df["volatility"] / 6.0, 0, 1)
+        + 0.1 * np.clip(df["ratio"] / 1.2, 0, 1)
     )
-    return round(base * 100, 2)
+    return np.round(base.to_numpy() * 100, 2)
 
 
 def train(db_path: Path | None, output_dir: Path, node: str | None):
@@ -194,7 +134,7 @@ def train(db_path: Path | None, output_dir: Path, node: str | None):
 
     output_dir.mkdir(parents=True, exist_ok=True)
     # Source classifier model (weak supervision)
-    window_df = build_window_features(binned, window=6)
+    window_df = build_window_features(binned)
     source_model = None
     source_classes = []
     if not window_df.empty:
@@ -215,7 +155,7 @@ def train(db_path: Path | None, output_dir: Path, node: str | None):
     risk_model = None
     if not window_df.empty:
         risk_df = window_df.copy()
-        risk_df["target"] = risk_df.apply(vulnerability_score, axis=1)
+        risk_df["target"] = vulnerability_score(risk_df)
         risk_X = risk_df.drop(columns=["label", "target"])
         risk_y = risk_df["target"]
         risk_model = HistGradientBoostingRegressor(max_depth=5, learning_rate=0.08, max_iter=250, random_state=42)
@@ -233,6 +173,7 @@ def train(db_path: Path | None, output_dir: Path, node: str | None):
             "model_vulnerability": risk_model,
             "source_classes": source_classes,
             "trained_at": datetime.now(timezone.utc).isoformat(),
+            "feature_schema": FEATURE_SCHEMA,
             "r2_pm25": r2_25,
             "r2_pm10": r2_10,
             "r2_vulnerability": r2_risk,